@@ -0,0 +1,19 @@
+# atomic_write.py
+# Gil Walzer
+
+import os
+
+# writes to a temporary file first and renames it over filepath_full, so readers never see half a file
+def write_file(filepath_full, data):
+    filepath_temp = filepath_full + ".tmp"
+    with open(filepath_temp, "wb") as outFile:
+        outFile.write(data)
+        # on disk before the rename, or a crash can leave an empty file under the real name
+        outFile.flush()
+        os.fsync(outFile.fileno())
+    try:
+        os.rename(filepath_temp, filepath_full)
+    except OSError:
+        # windows won't rename over an existing file
+        os.remove(filepath_full)
+        os.rename(filepath_temp, filepath_full)
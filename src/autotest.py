@@ -154,8 +154,13 @@ def get_analyses(fnames):
 		for fname in fnamelist:
 			all_fnames.append(fname)
 
-	train_test_analyses = debug.read_analyses_by_ids("GwernJSONAnalyses", all_fnames)
-	experimental_analyses = debug.read_analyses_except_ids("GwernJSONAnalyses", set(all_fnames))
+	if debug.has_analyses_columns("GwernJSONAnalyses"):
+		# the column store loads in one read instead of a file open per vendor
+		train_test_analyses = debug.read_analyses_columns("GwernJSONAnalyses", ids=all_fnames)
+		experimental_analyses = debug.read_analyses_columns("GwernJSONAnalyses", no_ids=set(all_fnames))
+	else:
+		# one directory scan, files read and decoded on 8 threads
+		train_test_analyses, experimental_analyses = debug.read_analyses_partitioned("GwernJSONAnalyses", all_fnames, jobs=8)
 
 	return (train_test_analyses, experimental_analyses)
 
@@ -122,4 +122,5 @@ def get_survey_data(seen_threshold, trust_class_thresholds):
 	
 	return data
 
-print get_survey_results()
\ No newline at end of file
+if __name__ == "__main__":
+	print get_survey_results()
\ No newline at end of file
@@ -1,92 +1,307 @@
 # iw_debug.py
 # Gil Walzer
 
-import parse_vendors, rigorous_analysis
-import os, json, codecs
+import parse_vendors, rigorous_analysis, vendor_db, shards, atomic_write
+import os, io, json, codecs, functools, hashlib
+from multiprocessing.pool import ThreadPool
+
+# ujson decodes a good deal faster when it is installed; before 2.0 it rounded floats, so skip those
+try:
+    import ujson
+    if int(ujson.__version__.split(".")[0]) < 2:
+        ujson = None
+except ImportError:
+    ujson = None
+
+# When set by use_database, the vendor and analysis readers and writers below go 
+# through this VendorDB instead of one json file per record.
+database = None
+
+def use_database(filename):
+    global database
+    database = vendor_db.VendorDB("../../Deep Web Data/" + filename)
 
 def write_analyses_json(analyses, classifier):
+    if database is not None:
+        return database.write_analyses(analyses, classifier)
     filepath = "../../Deep Web Data/" + classifier + "/"
     try:
         os.stat(filepath)
     except:
         os.mkdir(filepath) 
-    for analysis in analyses:
-        filepath_full = filepath + analysis.vendor_id + ".json"
-        with codecs.open(filepath_full, 'w+', errors="ignore") as outFile:
-            outFile.write(json.dumps(analysis.__dict__).encode("UTF-8"))
-
-def read_analyses_json(classifier):
+    sharded = shards.is_sharded(filepath)
+    with BatchWriter() as writer:
+        for analysis in analyses:
+            filepath_full = shards.record_path(filepath, analysis.vendor_id, sharded)
+            writer.write(filepath_full, json.dumps(analysis.__dict__).encode("UTF-8"))
+
+def read_analyses_json(classifier, **keyword_parameters):
+    if database is not None:
+        return database.read_analyses(classifier)
     filepath = "../../Deep Web Data/" + classifier + "/"
-    filenames = os.listdir(filepath)
-    
-    analyses = []
+    records = shards.list_records(filepath)
     
-    for filename in filenames:
-        
-        with codecs.open(filepath + filename, "r", "utf-8", errors="ignore") as analysis_file:
-            analysis_data = analysis_file.read()
-            analysis = rigorous_analysis.create_Analysis_from_json(analysis_data)
-            #print analysis.__dict__
-            analyses.append(analysis)
+    return load_analyses([path for (fid, path) in records], **keyword_parameters)
 
-    return analyses
+def read_analyses_by_ids(classifier, ids, **keyword_parameters):
+    if database is not None:
+        return database.read_analyses_by_ids(classifier, ids)
+    filepath = "../../Deep Web Data/" + classifier + "/"
+
+    return load_analyses([shards.find_record_path(filepath, fid) for fid in ids], **keyword_parameters)
 
-def read_analyses_by_ids(classifier, ids):
+def read_analyses_except_ids(classifier, no_ids, **keyword_parameters):
+    if database is not None:
+        return database.read_analyses_except_ids(classifier, no_ids)
     filepath = "../../Deep Web Data/" + classifier + "/"
-    analyses = []
+    records = shards.list_records(filepath)
+    
+    paths = []
+    for (fid, path) in records:
+        if fid not in no_ids:   
+            paths.append(path)
 
-    for fid in ids:
-        with codecs.open(filepath + fid + ".json", "r", "utf-8", errors="ignore") as analysis_file:
-            analysis_data = analysis_file.read()
-            analysis = rigorous_analysis.create_Analysis_from_json(analysis_data)
-            
-            analyses.append(analysis)
+    return load_analyses(paths, **keyword_parameters)
 
-    return analyses
+# {vendor id: Analysis} for everything analyzed under classifier so far
+def read_analyses_by_vendor(classifier, **keyword_parameters):
+    if database is None and not os.path.exists("../../Deep Web Data/" + classifier + "/"):
+        return {}
+    return dict((analysis.vendor_id, analysis) for analysis in read_analyses_json(classifier, **keyword_parameters))
 
-def read_analyses_except_ids(classifier, no_ids):
+# read_analyses_by_ids and read_analyses_except_ids together, from one directory listing
+def read_analyses_partitioned(classifier, ids, **keyword_parameters):
+    if database is not None:
+        return (database.read_analyses_by_ids(classifier, ids), database.read_analyses_except_ids(classifier, set(ids)))
     filepath = "../../Deep Web Data/" + classifier + "/"
-    filenames = os.listdir(filepath)
-    
+    records = shards.list_records(filepath)
+
+    wanted = set(ids)
+    paths = dict(records)
+    selected = [paths.get(fid, filepath + fid + ".json") for fid in ids]
+    rest = []
+    for (fid, path) in records:
+        if fid not in wanted:
+            rest.append(path)
+
+    analyses = load_analyses(selected + rest, **keyword_parameters)
+    return (analyses[:len(selected)], analyses[len(selected):])
+
+# Analyses for each path, in order. jobs=N reads and decodes them on N threads, and 
+# lazy=True returns LazyAnalysis records that only read their file when first used.
+def load_analyses(paths, **keyword_parameters):
+    if "lazy" in keyword_parameters and keyword_parameters["lazy"]:
+        return [LazyAnalysis(path) for path in paths]
+
+    if "jobs" in keyword_parameters:
+        jobs = keyword_parameters["jobs"]
+    else:
+        jobs = 1
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(load_analysis_file, paths, 64)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [load_analysis_file(path) for path in paths]
+
+def load_analysis_file(filepath_full):
+    with codecs.open(filepath_full, "r", "utf-8", errors="ignore") as analysis_file:
+        analysis_data = analysis_file.read()
+    return rigorous_analysis.create_Analysis_from_dict(decode_json(analysis_data))
+
+def decode_json(data):
+    if ujson is not None:
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            # e.g. NaN, which json writes but ujson won't read
+            pass
+    return json.loads(data)
+
+class LazyAnalysis:
+    """ Stands in for the Analysis in filepath_full. vendor_id comes from the file name; 
+    anything else loads the file the first time it is asked for. """
+    def __init__(self, filepath_full):
+        self.filepath_full = filepath_full
+        self.vendor_id = os.path.basename(filepath_full).split(".json")[0]
+        self.analysis = None
+
+    def load(self):
+        if self.analysis is None:
+            self.analysis = load_analysis_file(self.filepath_full)
+        return self.analysis
+
+    def __getattr__(self, name):
+        # only reached for attributes this record doesn't have itself
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+# The column store keeps Analysis.flat_attributes for every analysis in one .npy matrix, 
+# so the whole feature table loads in one read instead of one file per vendor. 
+# ints.npy marks the values that were ints (the networks divide those differently) and 
+# index.json holds the ids, usernames and any values that weren't numbers at all.
+# Each file is swapped in whole, index.json last, and the index keeps the row count and a
+# stamp of the matrices and ids, so a store left half-written by a crash is refused.
+def write_analyses_columns(analyses, classifier):
+    # numpy is only imported by the column store, so the json readers load quickly
+    import numpy
+    filepath = "../../Deep Web Data/" + classifier + "Columns/"
+    try:
+        os.stat(filepath)
+    except:
+        os.mkdir(filepath) 
+
+    attrs = rigorous_analysis.Analysis.flat_attributes
+    ids, usernames, rows, int_rows, other_values = [], [], [], [], {}
+    for analysis in analyses:
+        flat_dict, flat_tuple = analysis.flatten()
+        row, int_row = [], []
+        for attr in attrs:
+            value = flat_dict[attr]
+            if type(value) in (int, long, float):
+                row.append(float(value))
+            else:
+                row.append(float("nan"))
+                other_values.setdefault(str(len(rows)), {})[attr] = value
+            int_row.append(type(value) in (int, long))
+        ids.append(analysis.vendor_id)
+        usernames.append(analysis.username)
+        rows.append(row)
+        int_rows.append(int_row)
+
+    flat = numpy.array(rows, dtype=numpy.float64).reshape(len(rows), len(attrs))
+    ints = numpy.array(int_rows, dtype=numpy.bool_).reshape(len(rows), len(attrs))
+    atomic_write.write_file(filepath + "flat.npy", npy_bytes(flat))
+    atomic_write.write_file(filepath + "ints.npy", npy_bytes(ints))
+    index = {"attributes": attrs, "ids": ids, "usernames": usernames, "other_values": other_values,
+        "rows": len(rows), "stamp": columns_stamp(ids, flat, ints)}
+    atomic_write.write_file(filepath + "index.json", json.dumps(index).encode("UTF-8"))
+
+def npy_bytes(matrix):
+    import numpy
+    buffer = io.BytesIO()
+    numpy.save(buffer, matrix)
+    return buffer.getvalue()
+
+# a hash of the ids and both matrices, which changes if any of them do
+def columns_stamp(ids, flat, ints):
+    import numpy
+    stamp = hashlib.sha1(json.dumps(ids))
+    for matrix in (flat, ints):
+        stamp.update(str(matrix.shape))
+        stamp.update(numpy.ascontiguousarray(matrix).tostring())
+    return stamp.hexdigest()
+
+# stores written before the index had a stamp can't be checked, so they don't count
+def has_analyses_columns(classifier):
+    filepath_index = "../../Deep Web Data/" + classifier + "Columns/index.json"
+    if not os.path.exists(filepath_index):
+        return False
+    with codecs.open(filepath_index, "r", "utf-8", errors="ignore") as index_file:
+        index = json.loads(index_file.read())
+    return "stamp" in index
+
+# returns (index, flat, ints); the matrices are memory-mapped, one row per id in index["ids"].
+# Raises ValueError if the matrices aren't the ones index.json was written with.
+def read_analyses_table(classifier):
+    import numpy
+    filepath = "../../Deep Web Data/" + classifier + "Columns/"
+    with codecs.open(filepath + "index.json", "r", "utf-8", errors="ignore") as index_file:
+        index = json.loads(index_file.read())
+    flat = numpy.load(filepath + "flat.npy", mmap_mode="r")
+    ints = numpy.load(filepath + "ints.npy", mmap_mode="r")
+
+    shape = (index.get("rows"), len(index["attributes"]))
+    if flat.shape != shape or ints.shape != shape or len(index["ids"]) != shape[0]:
+        raise ValueError("column store for " + classifier + " doesn't match its index; write it again")
+    if index.get("stamp") != columns_stamp(index["ids"], flat, ints):
+        raise ValueError("column store for " + classifier + " is stale or half-written; write it again")
+    return index, flat, ints
+
+# FlatAnalysis objects from the column store, for every id, just ids (in that order), or all but no_ids
+def read_analyses_columns(classifier, **keyword_parameters):
+    index, flat, ints = read_analyses_table(classifier)
+    ids = index["ids"]
+
+    if "ids" in keyword_parameters:
+        rows = {}
+        for row in range(len(ids)):
+            rows[ids[row]] = row
+        selected = [rows[fid] for fid in keyword_parameters["ids"]]
+    elif "no_ids" in keyword_parameters:
+        no_ids = keyword_parameters["no_ids"]
+        selected = [row for row in range(len(ids)) if ids[row] not in no_ids]
+    else:
+        selected = range(len(ids))
+
+    attrs = index["attributes"]
+    other_values = index["other_values"]
     analyses = []
-    
-    for filename in filenames:
-        fid = filename.split(".json")[0]
-        if fid not in no_ids:   
-            with codecs.open(filepath + filename, "r", "utf-8", errors="ignore") as analysis_file:
-                analysis_data = analysis_file.read()
-                analysis = rigorous_analysis.create_Analysis_from_json(analysis_data)
-                #print analysis.__dict__
-                analyses.append(analysis)
+    for row in selected:
+        values = flat[row].tolist()
+        int_values = ints[row].tolist()
+        flat_dict = {}
+        for k in range(len(attrs)):
+            if int_values[k]:
+                flat_dict[attrs[k]] = int(values[k])
+            else:
+                flat_dict[attrs[k]] = values[k]
+        if str(row) in other_values:
+            flat_dict.update(other_values[str(row)])
+        analyses.append(rigorous_analysis.FlatAnalysis(ids[row], index["usernames"][row], flat_dict))
 
     return analyses
 
-
 def write_vendors_json(vendors, classifier):
+    for vendor in iter_write_vendors_json(vendors, classifier):
+        pass
+
+# writes each vendor as it is pulled through, then hands it on
+def iter_write_vendors_json(vendors, classifier):
+    if database is not None:
+        for vendor in database.iter_write_vendors(vendors, classifier):
+            yield vendor
+        return
     filepath = "../../Deep Web Data/" + classifier + "/"
     try:
         os.stat(filepath)
     except:
         os.mkdir(filepath) 
-    for vendor in vendors:
-        filepath_full = filepath + vendor.id + ".json"
-        with codecs.open(filepath_full, 'w+', errors="ignore") as outFile:
-            outFile.write(json.dumps(vendor.__dict__).encode("UTF-8"))
+    sharded = shards.is_sharded(filepath)
+    usernames = read_username_index(classifier)
+    writer = BatchWriter()
+    try:
+        for vendor in vendors:
+            filepath_full = shards.record_path(filepath, vendor.id, sharded)
+            writer.write(filepath_full, json.dumps(vendor.__dict__).encode("UTF-8"))
+            usernames[vendor.username] = vendor.id
+            yield vendor
+    finally:
+        writer.close()
+        write_username_index(classifier, usernames)
 
 def read_vendors_json(classifier):
+    return list(iter_vendors_json(classifier))
+
+def iter_vendors_json(classifier):
+    if database is not None:
+        for vendor in database.iter_vendors(classifier):
+            yield vendor
+        return
     filepath = "../../Deep Web Data/" + classifier + "/"
-    filenames = os.listdir(filepath)
+    records = shards.list_records(filepath)
 
-    vendors = []
-    
-    for filename in filenames:
+    for (fid, path) in records:
         
-        with codecs.open(filepath + filename, "r", "utf-8", errors="ignore") as vendor_file:
+        with codecs.open(path, "r", "utf-8", errors="ignore") as vendor_file:
             vendor_data = vendor_file.read()
             vendor = parse_vendors.create_Vendor_from_json(vendor_data)
-            vendors.append(vendor)
-
-    return vendors
+        yield vendor
 
 def write_final_results(classifier, threadname, keep_experiments):    
     filepath = "../../Deep Web Data/" + classifier + "/"
@@ -127,23 +342,34 @@ def write_each_attr_results(classifier, attrs, mse, results):
 
 
 def read_unanalyzed_vendors_json(classifier):
+    return list(iter_unanalyzed_vendors_json(classifier))
+
+def iter_unanalyzed_vendors_json(classifier):
+    if database is not None:
+        for vendor in database.iter_unanalyzed_vendors(classifier):
+            yield vendor
+        return
+
 
     filepath = "../../Deep Web Data/" + classifier
-    filenames = os.listdir(filepath + "/")
+    records = shards.list_records(filepath + "/")
     
-    analyzed_already = os.listdir(filepath + "Analyses")
-    aa_fnames = set(analyzed_already)
+    analyzed_already = shards.list_records(filepath + "Analyses/")
+    aa_ids = set(fid for (fid, path) in analyzed_already)
 
-    vendors = []
-    
-    for filename in filenames:
-        if filename not in aa_fnames:
-            with codecs.open(filepath + filename, "r", "utf-8", errors="ignore") as vendor_file:
+    for (fid, path) in records:
+        if fid not in aa_ids:
+            with codecs.open(path, "r", "utf-8", errors="ignore") as vendor_file:
                 vendor_data = vendor_file.read()
                 vendor = parse_vendors.create_Vendor_from_json(vendor_data)
-                vendors.append(vendor)
+            yield vendor
 
-    return vendors
+# moves the json records under classifier into the sharded layout; readers take either
+# layout, and the writers above follow whichever one the directory is in
+def migrate_to_sharded(classifier):
+    if database is not None:
+        raise ValueError("records in the database aren't kept in directories")
+    return shards.migrate_to_sharded("../../Deep Web Data/" + classifier + "/")
 
 def write_vendors_files(vendors, classifier):
 
@@ -159,10 +385,9 @@ def write_vendors_files(vendors, classifier):
             outFile.write(vendor.__str__().encode("UTF-8"))
 
 def get_ids_for_usernames(unames):
-    vendors = read_vendors_json("GwernJSON")
-    all_v = {}
-    for v in vendors:
-        all_v[v.username] = v.id
+    if database is not None:
+        return database.get_ids_for_usernames("GwernJSON", unames)
+    all_v = read_username_index("GwernJSON")
 
     idents = []
     for uname in unames:
@@ -173,6 +398,36 @@ def get_ids_for_usernames(unames):
 
     return idents
 
+# username -> vendor id for every vendor written under classifier, kept up to date by 
+# iter_write_vendors_json so lookups don't have to read every vendor file
+username_indexes = {}
+
+def read_username_index(classifier):
+    if classifier in username_indexes:
+        return username_indexes[classifier]
+
+    filepath_index = "../../Deep Web Data/" + classifier + "Usernames.json"
+    try:
+        with codecs.open(filepath_index, "r", "utf-8", errors="ignore") as index_file:
+            usernames = json.loads(index_file.read())
+    except IOError:
+        # no index yet, build one from the vendors already written
+        usernames = {}
+        if os.path.exists("../../Deep Web Data/" + classifier + "/"):
+            for v in iter_vendors_json(classifier):
+                usernames[v.username] = v.id
+            write_json_file(filepath_index, usernames)
+
+    username_indexes[classifier] = usernames
+    return usernames
+
+def write_username_index(classifier, usernames):
+    username_indexes[classifier] = usernames
+    write_json_file("../../Deep Web Data/" + classifier + "Usernames.json", usernames)
+
+def write_json_file(filepath_full, data):
+    atomic_write.write_file(filepath_full, json.dumps(data).encode("UTF-8"))
+
 def print_vendor_usernames(vendors, directory, filename):
     
     filepath = "../../Deep Web Data/" + directory + "/"
@@ -186,20 +441,85 @@ def print_vendor_usernames(vendors, directory, filename):
         with codecs.open(filepath_full, "a", "utf-8") as outFile:
             outFile.write(vendor.id + " " + vendor.username + "\n")
               
+# incremental parses check whether a page's output is still there; with a database it is
+# there, not in the output directory
+def with_record_check(keyword_parameters):
+    if database is not None and "record_exists" not in keyword_parameters:
+        if "output" in keyword_parameters:
+            output = keyword_parameters["output"]
+        else:
+            output = "GwernJSON"
+        keyword_parameters["record_exists"] = functools.partial(database.record_exists, output)
+    return keyword_parameters
+
 def parse_sample(**keyword_parameters):
     if "sample" in keyword_parameters:
         sample_count = keyword_parameters["sample"]
     else:
         sample_count = 11
-    sample = parse_vendors.parse_vendors(sample=sample_count)
+    keyword_parameters["sample"] = sample_count
+    sample = parse_vendors.parse_vendors(**with_record_check(keyword_parameters))
     return sample
 
-def parse_all():
-    return parse_vendors.parse_vendors()
+def parse_all(**keyword_parameters):
+    return parse_vendors.parse_vendors(**with_record_check(keyword_parameters))
+
+def iter_sample(**keyword_parameters):
+    if "sample" not in keyword_parameters:
+        keyword_parameters["sample"] = 11
+    return parse_vendors.iter_vendors(**with_record_check(keyword_parameters))
+
+def iter_all(**keyword_parameters):
+    return parse_vendors.iter_vendors(**with_record_check(keyword_parameters))
 
 def print_vendor(vendor):
     print vendor.profile, vendor.reviews
 
 def print_analyses(analyses):
     for analysis in analyses:
-        print analysis.__dict__
\ No newline at end of file
+        print analysis.__dict__
+
+class BatchWriter:
+    """ Collects (filepath_full, data) writes and hands them to a thread pool batch_size at a time,
+    so the caller doesn't wait on each open and close. Every file goes through
+    atomic_write.write_file, so a crash leaves at most a stray .tmp file, never a truncated
+    one. close() waits until every write is on disk and raises the first error any of them hit. """
+    def __init__(self, batch_size=256, threads=4):
+        self.batch_size = batch_size
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.batch = []
+        self.pending = []
+
+    def write(self, filepath_full, data):
+        self.batch.append((filepath_full, data))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) > 0:
+            self.pending.append(self.pool.apply_async(write_files, (self.batch,)))
+            self.batch = []
+        # don't let unwritten batches pile up when the disk is the slow part
+        while len(self.pending) > self.threads * 2:
+            self.pending.pop(0).get()
+
+    def close(self):
+        try:
+            self.flush()
+            for result in self.pending:
+                result.get()
+            self.pending = []
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def write_files(batch):
+    for (filepath_full, data) in batch:
+        atomic_write.write_file(filepath_full, data)
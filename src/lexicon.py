@@ -0,0 +1,87 @@
+# lexicon.py
+# Gil Walzer
+
+import re, json, hashlib
+
+# The word lists the uncertainty and nonimmediacy features count. Each count is the sum of
+# text.count(word) over the list, so a word listed twice counts twice.
+LEXICONS = {
+    "uncertainty": ["appear", "Appear",
+        "seem", "Seem",
+        "suggest", "Suggest",
+        "indicat", "Indicat",
+        "assum", "Assum",
+        "imply", "implie", "Imply", "Implie",
+        "hope", "Hope", "hoping", "Hoping",
+        "Think so", "think so"],
+    "other_reference": [" he ", "He ", " she ", "She ",
+        " him.", " him,", " him ", "himself",
+        " her.", " her,", " her ", "herself",
+        "It ", " it ", " it.", " it ", " itself ",
+        " they", "They", "Them", "them",
+        ],
+    "self_reference": ["I ", " i ", " me.", " me!", " me,", " me ", "Me "],
+    "group_reference": ["We ", " we ", " us ", " us,", " us.", " Us ", " Us.", " us!", " Us!"],
+}
+
+class LexiconMatcher:
+    """ Counts every word of every lexicon in one scan of the text, giving exactly what
+    summing text.count(word) over each lexicon would. One regex finds the longest word
+    starting at each position; every other word starting there is a prefix of that one.
+    As with str.count, a word's occurrences don't overlap each other, though different
+    words' may. """
+    def __init__(self, lexicons=None):
+        # the given lexicons replace those of LEXICONS with the same name; the rest are kept
+        merged = dict(LEXICONS)
+        if lexicons is not None:
+            merged.update(lexicons)
+        self.lexicons = dict((name, list(words)) for (name, words) in merged.items())
+
+        # each distinct word, and how many times each lexicon lists it
+        self.words = []
+        self.weights = {}
+        for (name, words) in self.lexicons.items():
+            for word in words:
+                if len(word) is 0:
+                    raise ValueError("empty word in lexicon " + name)
+                if word not in self.weights:
+                    self.words.append(word)
+                    self.weights[word] = {}
+                self.weights[word][name] = self.weights[word].get(name, 0) + 1
+
+        self.words.sort(key=len, reverse=True)
+        # the words that start where each word does: itself and its prefixes
+        self.prefixes = {}
+        for word in self.words:
+            self.prefixes[word] = [other for other in self.words if word.startswith(other)]
+
+        if len(self.words) is 0:
+            self.pattern = None
+        else:
+            alternation = "|".join(re.escape(word) for word in self.words)
+            self.pattern = re.compile("(?=(" + alternation + "))", re.UNICODE)
+
+    # a short hash of the named lexicons, which changes whenever any of their words do
+    def digest(self, names):
+        return hashlib.md5(json.dumps([self.lexicons[name] for name in names])).hexdigest()[:8]
+
+    # {lexicon name: count} for text
+    def counts(self, text):
+        counts = dict((name, 0) for name in self.lexicons)
+        if self.pattern is None:
+            return counts
+
+        found = dict((word, 0) for word in self.words)
+        ends = dict((word, 0) for word in self.words)
+        for match in self.pattern.finditer(text):
+            start = match.start()
+            for word in self.prefixes[match.group(1)]:
+                if start >= ends[word]:
+                    found[word] += 1
+                    ends[word] = start + len(word)
+
+        for word in self.words:
+            if found[word] > 0:
+                for (name, weight) in self.weights[word].items():
+                    counts[name] += found[word] * weight
+        return counts
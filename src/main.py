@@ -1,74 +1,100 @@
 # main.py 
 # Gil Walzer
 
-import parse_vendors, debug, sys
-from rigorous_analysis import Analyzer, Analysis
+import parse_vendors, debug, sys, rigorous_analysis, timing
+from rigorous_analysis import Analyzer, AnalyzerPool, Analysis
 from neuralnetwork import MyNN
 
+def handle_options(args):
+	# pull "--name=value" options out of args so the positional commands keep their places;
+	# a bare "--name" is the same as "--name=on"
+	options = {"jobs": 1, "scraper": "regex", "reader": "codecs"}
+	for arg in list(args):
+		if arg.startswith("--"):
+			if "=" in arg:
+				name, value = arg[2:].split("=", 1)
+			else:
+				name, value = arg[2:], "on"
+			if name == "jobs":
+				value = int(value)
+			options[name] = value
+			args.remove(arg)
+	return options
+
 def handle_args(args):
+	options = handle_options(args)
+	if "db" in options:
+		debug.use_database(options["db"])
+	if options.get("timing") == "on":
+		timing.enable()
+	doc_cache = None
+	if "doc-cache" in options:
+		doc_cache = "../../Deep Web Data/" + options["doc-cache"]
+	if "sentiment-cache" in options:
+		rigorous_analysis.sentiment_cache.load("../../Deep Web Data/" + options["sentiment-cache"])
+	# keyword parameters for parse_vendors.iter_vendors
+	parse_options = {}
+	for name in ["jobs", "scraper", "reader", "archive"]:
+		if name in options:
+			parse_options[name] = options[name]
 	analyses = []
 	if len(sys.argv) is 1 or len(sys.argv) > 4:
-		sys.stderr.write("\ncommands:\tpython main.py [sample (optional count)] \n\t\tpython main.py [json (v or a)]\n")
+		sys.stderr.write("\ncommands:\tpython main.py [sample (optional count)] \n\t\tpython main.py [json (v, a or c)]\n\t\tpython main.py [shard (GwernJSON, GwernJSONAnalyses, ...)]\n")
+		sys.stderr.write("options:\t--jobs=N (parse vendor pages and analyze vendors on N processes)\n")
+		sys.stderr.write("\t\t--scraper=regex|fast (profile scraper to parse with)\n")
+		sys.stderr.write("\t\t--reader=codecs|mmap (how vendor pages are read)\n")
+		sys.stderr.write("\t\t--archive=crawl.tar.gz (read vendor pages from a tar or zip archive)\n")
+		sys.stderr.write("\t\t--db=Gwern.db (keep vendors and analyses in an SQLite file)\n")
+		sys.stderr.write("\t\t--sentiment-cache=VaderCache.json (keep VADER scores between runs)\n")
+		sys.stderr.write("\t\t--doc-cache=Docs.db (keep parsed profiles between runs)\n")
+		sys.stderr.write("\t\t--timing or --timing=on (print where parsing and analysis time went)\n")
 		sys.exit(1)
 
 	elif len(sys.argv) is 2:
 		if sys.argv[1] == "sample":
 			# default sample count is 10
-			vendors = debug.parse_sample()		
-
-			debug.write_vendors_json(vendors, "GwernSampleJSON")
+			# vendors are written out as the analysis loop pulls them through
+			vendors = debug.iter_write_vendors_json(debug.iter_sample(**parse_options), "GwernSampleJSON")
 
-
-			analyzer = Analyzer()
-			analyses = []
-			for each in vendors:
-				analysis = analyzer.analyze(each)
-				analyses.append(analysis)
+			with AnalyzerPool(jobs=options["jobs"], doc_cache=doc_cache) as analyzer:
+				analyses = list(analyzer.analyze_many(vendors))
 
 			debug.write_analyses_json(analyses, "GwernSampleJSONAnalyses")
 
 		elif "all" in sys.argv[1]:
- 			vendors = debug.parse_all()
+			vendors = debug.iter_write_vendors_json(debug.iter_all(**parse_options), "GwernJSON")
 
-			debug.write_vendors_json(vendors, "GwernJSON")
-
-			analyzer = Analyzer()
-			analyses = []
-			for each in vendors:
-				analysis = analyzer.analyze(each)
-				analyses.append(analysis)
+			with AnalyzerPool(jobs=options["jobs"], doc_cache=doc_cache) as analyzer:
+				analyses = list(analyzer.analyze_many(vendors))
 
 			debug.write_analyses_json(analyses, "GwernJSONAnalyses")
+			debug.write_analyses_columns(analyses, "GwernJSONAnalyses")
 
 		else:
 			# write the vendors that were parsed
-			vendors = debug.parse_all()
-			debug.write_vendors_json(vendors, "GwernJSON")
+			# only pages that are new or changed since the last run get scraped again
+			debug.write_vendors_json(debug.iter_all(incremental=True, **parse_options), "GwernJSON")
 
-			vendors = debug.read_unanalyzed_vendors_json("GwernJSON")
+			# only vendors that are new, whose profile or reviews changed, or whose features'
+			# code changed are analyzed again, and only their stale features
+			previous = debug.read_analyses_by_vendor("GwernJSONAnalyses", jobs=8)
+			vendors = debug.iter_vendors_json("GwernJSON")
 
-			analyzer = Analyzer()
-			analyses = []
-			for each in vendors:
-				analysis = analyzer.analyze(each)
-				analyses.append(analysis)
+			with AnalyzerPool(jobs=options["jobs"], doc_cache=doc_cache) as analyzer:
+				analyses = list(analyzer.reanalyze_many(vendors, previous))
 
 			debug.write_analyses_json(analyses, "GwernJSONAnalyses")
 			analyses = debug.read_analyses_json("GwernJSONAnalyses")
+			debug.write_analyses_columns(analyses, "GwernJSONAnalyses")
 
 	elif len(sys.argv) is 3:
 
 		if sys.argv[1] == "sample":
 			sample_count = int(sys.argv[2]) 
-			vendors = debug.parse_sample(sample_count)
+			vendors = debug.iter_write_vendors_json(debug.iter_sample(sample=sample_count, **parse_options), "GwernSampleJSON")
 
-			debug.write_vendors_json(vendors, "GwernSampleJSON")
-
-			analyzer = Analyzer()
-			analyses = []
-			for each in vendors:
-				analysis = analyzer.analyze(each)
-				analyses.append(analysis)
+			with AnalyzerPool(jobs=options["jobs"], doc_cache=doc_cache) as analyzer:
+				analyses = list(analyzer.analyze_many(vendors))
 
 			debug.write_analyses_json(analyses, "GwernSampleJSONAnalyses")
 
@@ -77,21 +103,39 @@ def handle_args(args):
 				 
 			if sys.argv[2] == "v":
 				sys.stderr.write("\nReading vendors.\n")
-				analyzer = Analyzer()
-				vendors = debug.read_vendors_json("GwernJSON")
+				vendors = debug.iter_vendors_json("GwernJSON")
 				#debug.write_vendors_json(vendors, "GwernSampleJSON")
 
-				analyses = []
-				for each in vendors:
-					analysis = analyzer.analyze(each)
-					analyses.append(analysis)
+				with AnalyzerPool(jobs=options["jobs"], doc_cache=doc_cache) as analyzer:
+					analyses = list(analyzer.analyze_many(vendors))
 
 				debug.write_analyses_json(analyses, "GwernJSONAnalyses")
+				debug.write_analyses_columns(analyses, "GwernJSONAnalyses")
 
 			elif sys.argv[2] == "a":
 				sys.stderr.write("\nReading analyses.\n")
 				analyses = debug.read_analyses_json("GwernJSONAnalyses")
 
+			elif sys.argv[2] == "c":
+				sys.stderr.write("\nBuilding the analysis column store.\n")
+				analyses = debug.read_analyses_json("GwernJSONAnalyses")
+				debug.write_analyses_columns(analyses, "GwernJSONAnalyses")
+
+		elif sys.argv[1] == "shard":
+			# existing records move into hashed subdirectories; readers take either layout
+			moved = debug.migrate_to_sharded(sys.argv[2])
+			sys.stderr.write("\nMoved " + str(moved) + " records into shards.\n")
+			analyses = []
+
+	stats = rigorous_analysis.sentiment_cache.stats()
+	if stats["hits"] + stats["misses"] > 0:
+		sys.stderr.write("\nSentiment cache: " + str(stats["hits"]) + " hits, " + str(stats["misses"]) + " misses (" 
+			+ str(int(stats["hit_rate"] * 100)) + "% hit rate).\n")
+	if "sentiment-cache" in options:
+		rigorous_analysis.sentiment_cache.save("../../Deep Web Data/" + options["sentiment-cache"])
+	if timing.enabled:
+		sys.stderr.write("\n" + timing.summary())
+
 	return analyses
 
 def test_nn(analyses):
@@ -1,6 +1,8 @@
 # parse_vendors.py
 # Gil Walzer
-import codecs, os, re, sqlite3, json
+import codecs, os, re, sqlite3, json, functools, itertools, multiprocessing, mmap
+import tarfile, zipfile, time
+import shards, timing, atomic_write
 from HTMLParser import HTMLParser
 
 class Vendor: 
@@ -26,17 +28,43 @@ def create_Vendor_from_json(jsons):
     vendor = Vendor(v["username"], v["id"], v["months"], v["rank"], v["feedback"], v["transactions"], v["fans"], v["profile"], v["reviews_string"], v["reviews"])
     return vendor
 
+# "regex" is the original split-and-scan scraper, "fast" does the same job in one pass
+PROFILE_SCRAPERS = ("regex", "fast")
+
+# "codecs" decodes each whole page, "mmap" maps it and decodes only the profile and reviews
+PAGE_READERS = ("codecs", "mmap")
+
+# the markers are plain ASCII, so these match the same way on decoded text and raw bytes
+PROFILE_REGION_RE = re.compile('<div class="h1">|</div><table class="zebra"><tr><th>category</th><th>title<th><th>price')
+REVIEW_TABLE_RE = re.compile('<table class="zebra"><tr><th>rating</th><th>review</th><th>freshness</th><th>item</th>')
+PROFILE_TAG_RE = re.compile("<[^<>]*>")
+RANK_SPLIT_RE = re.compile("[top |%]")
+REVIEW_ROW_RE = re.compile("</tr><tr>")
+REVIEW_TAG_RE = re.compile("<[^>]*>")
+PGP_BEGIN = "-----BEGIN PGP PUBLIC KEY BLOCK-----"
+PGP_END = "K-----"
+
 # May be depreciated
 def parse_vendors(**keyword_parameters):
+    return list(iter_vendors(**keyword_parameters))
+
+# Same keyword parameters as parse_vendors, but hands back one Vendor at a time
+# so callers never hold the whole crawl in memory.
+def iter_vendors(**keyword_parameters):
 
     print "start"
     filepath = "../../Deep Web Data/"
+
+    # where the parsed vendors end up; the manifest records paths in here
+    if "output" in keyword_parameters:
+        filepath_scanned = filepath + keyword_parameters['output']
+    else:
+        filepath_scanned = filepath + "GwernJSON"
     
     if "filepath" in keyword_parameters:
         filepath_files = filepath + keyword_parameters['filepath']
     else:
         filepath_files = filepath + "GwernVP"
-        filepath_scanned = filepath + "GwernJSON"
        
     if "sample" in keyword_parameters:
         limit = keyword_parameters['sample']
@@ -44,122 +72,356 @@ def parse_vendors(**keyword_parameters):
     else:
         limit = 100000    
 
+    # number of worker processes to scrape with; 1 scrapes in this process
+    if "jobs" in keyword_parameters:
+        jobs = keyword_parameters['jobs']
+    else:
+        jobs = 1
+
+    # which profile scraper to use, see PROFILE_SCRAPERS
+    if "scraper" in keyword_parameters:
+        scraper = keyword_parameters['scraper']
+    else:
+        scraper = "regex"
+    if scraper not in PROFILE_SCRAPERS:
+        raise ValueError("unknown scraper " + str(scraper))
+
+    # how pages are read off disk, see PAGE_READERS
+    if "reader" in keyword_parameters:
+        reader = keyword_parameters['reader']
+    else:
+        reader = "codecs"
+    if reader not in PAGE_READERS:
+        raise ValueError("unknown reader " + str(reader))
+
+    # only scrape pages that are new or changed since the last incremental run
+    if "incremental" in keyword_parameters:
+        incremental = keyword_parameters['incremental']
+    else:
+        incremental = False
+
+    if "manifest" in keyword_parameters:
+        manifest_path = keyword_parameters['manifest']
+    else:
+        manifest_path = filepath_scanned + "Manifest.json"
+
+    # called with a page's id to ask whether its output is still there; the default looks
+    # in filepath_scanned, so callers writing somewhere else (a database) pass their own
+    if "record_exists" in keyword_parameters:
+        record_exists = keyword_parameters['record_exists']
+    else:
+        record_exists = functools.partial(shards.record_exists, filepath_scanned + "/")
+
     filepath_files = filepath_files + "/"
-    filenames = os.listdir(filepath_files)
-    #print len(filenames)
-    
-    scanned_files = set(os.listdir(filepath_scanned + "/" ))
-    #print len(scanned_files)
 
+    # a tar or zip of vendor pages to read in place of the filepath directory
+    if "archive" in keyword_parameters:
+        members = iter_archive_members(os.path.join(filepath, keyword_parameters['archive']))
+    else:
+        members = iter_directory_members(filepath_files)
+
+    if incremental:
+        manifest = read_manifest(manifest_path)
+    else:
+        manifest = None
+    #print len(manifest)
+
+    entries = {}
+    pages = select_pages(members, filepath_files, limit, manifest, filepath_scanned, entries, record_exists)
+
+    if not incremental:
+        for (filename, vendor) in scrape_pages(pages, jobs, scraper, reader):
+            yield vendor
+        return
+
+    try:
+        for (filename, vendor) in scrape_pages(pages, jobs, scraper, reader):
+            yield vendor
+            # the caller has asked for the next vendor, so it is done with this one
+            manifest[filename] = entries.pop(filename)
+    finally:
+        write_manifest(manifest_path, manifest)
+
+# Members are (filename, size, mtime, read). Directory members leave size, mtime and read as
+# None; archive members must be read before moving on to the next one.
+def iter_directory_members(filepath_files):
+    for filename in os.listdir(filepath_files):
+        yield (filename, None, None, None)
+
+def iter_archive_members(archive_path):
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                yield (os.path.basename(info.filename), info.file_size, mtime, functools.partial(archive.read, info))
+    else:
+        # "r|*" streams the (possibly compressed) tarball front to back without seeking
+        with tarfile.open(archive_path, "r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                yield (os.path.basename(member.name), member.size, member.mtime, functools.partial(read_tar_member, archive, member))
+
+def read_tar_member(archive, member):
+    member_file = archive.extractfile(member)
+    try:
+        return member_file.read()
+    finally:
+        member_file.close()
+
+# Applies the sample limit and, given a manifest, skips unchanged pages. Yields pages for 
+# parse_vendor_page and fills entries with the manifest entry for each page it yields.
+def select_pages(members, filepath_files, limit, manifest, filepath_scanned, entries, record_exists):
     i = 0
-    vendors = []
-    nonascii_filenames = []
-    
-    for filename in filenames:
+    for (filename, size, mtime, read) in members:
         # for sampling
         if i > limit:
             break
         else:
             i += 1
-        
+
         # make sure the file hasn't been checked yet!
-        filename_json = filename.split(".")[0] + ".json"
-        #if filename_json not in scanned_files:
-        if True:
-            vendor_raw_html = ""
-            with codecs.open(filepath_files + filename, "r", "utf-8") as vendor_file:
-                vendor_raw_html = vendor_file.read()
-           
-            h = HTMLParser()
-           
-            profile_raw_info = re.split('<div class="h1">|</div><table class="zebra"><tr><th>category</th><th>title<th><th>price', vendor_raw_html)
-            profile_raw_info_2 = profile_raw_info[1]
+        if manifest is not None:
+            if read is None:
+                stat = os.stat(filepath_files + filename)
+                size, mtime = stat.st_size, stat.st_mtime
+            fid = filename.split(".")[0]
+            entry = {"size": size, "mtime": mtime, 
+                "output": filepath_scanned + "/" + fid + ".json"}
+            if manifest.get(filename) == entry and record_exists(fid):
+                timing.count("pages_unchanged")
+                continue
+            entries[filename] = entry
 
-            profile_scraped = re.split("<[^<>]*>", profile_raw_info_2)
+        if read is None:
+            yield (filename, filepath_files, None)
+        else:
+            yield (filename, None, read())
+
+# yields (filename, vendor) for each page, in the order the pages came in
+def scrape_pages(pages, jobs, scraper, reader):
+    if jobs > 1:
+        # scrape a window of pages at a time so finished vendors can't pile up
+        # faster than the caller uses them. pool.map hands results back in the
+        # order of the pages, so the vendors come out the same as they would
+        # from a single process
+        chunksize = 8
+        window = jobs * chunksize * 4
+        parse_page = functools.partial(parse_vendor_page, scraper=scraper, reader=reader)
+        if timing.enabled:
+            # the workers' timings come back with their vendors
+            parse_page = timing.Collecting(parse_page)
+        pool = multiprocessing.Pool(jobs, timing.reset)
+        try:
+            while True:
+                window_pages = list(itertools.islice(pages, window))
+                if len(window_pages) is 0:
+                    break
+                vendors = pool.map(parse_page, window_pages, chunksize)
+                if timing.enabled:
+                    vendors = timing.collect_results(vendors)
+                for k in range(len(window_pages)):
+                    yield (window_pages[k][0], vendors[k])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for page in pages:
+            yield (page[0], parse_vendor_page(page, scraper, reader))
+
+# the manifest maps each scraped page to its size, mtime and output file
+def read_manifest(manifest_path):
+    try:
+        with codecs.open(manifest_path, "r", "utf-8") as manifest_file:
+            return json.loads(manifest_file.read())
+    except IOError:
+        return {}
+
+def write_manifest(manifest_path, manifest):
+    atomic_write.write_file(manifest_path, json.dumps(manifest).encode("utf-8"))
+
+# a page is (filename, filepath_files, None) for a file on disk, or 
+# (filename, None, data) for the raw bytes of an archive member
+def parse_vendor_page(page, scraper="regex", reader="codecs"):
+    (filename, filepath_files, data) = page
+    if data is None:
+        return parse_vendor_file(filepath_files, filename, scraper, reader)
+    return parse_vendor_bytes(filename, data, scraper, reader)
+
+def parse_vendor_bytes(filename, data, scraper="regex", reader="codecs"):
+    started = timing.start()
+    if reader == "mmap":
+        # already in memory, but the regions can still be found before decoding
+        (profile_raw_info_2, review_raw_info_2) = split_page_regions_bytes(data)
+    else:
+        (profile_raw_info_2, review_raw_info_2) = split_page_regions(data.decode("utf-8"))
+    timing.stop("read_page", started)
+
+    started = timing.start()
+    vendor = scrape_vendor(filename, profile_raw_info_2, review_raw_info_2, scraper)
+    timing.stop("scrape_vendor", started)
+    return vendor
+
+def parse_vendor_file(filepath_files, filename, scraper="regex", reader="codecs"):
+    started = timing.start()
+    if reader == "mmap":
+        (profile_raw_info_2, review_raw_info_2) = read_page_regions_mmap(filepath_files + filename)
+    else:
+        vendor_raw_html = ""
+        with codecs.open(filepath_files + filename, "r", "utf-8") as vendor_file:
+            vendor_raw_html = vendor_file.read()
+        (profile_raw_info_2, review_raw_info_2) = split_page_regions(vendor_raw_html)
+    timing.stop("read_page", started)
+
+    started = timing.start()
+    vendor = scrape_vendor(filename, profile_raw_info_2, review_raw_info_2, scraper)
+    timing.stop("scrape_vendor", started)
+    return vendor
+
+# Returns the profile region and the review table region (None if there is no
+# review table), i.e. re.split(marker, page)[1] for each of the two markers.
+def split_page_regions(vendor_raw_html):
+    # only the piece between the first two markers is needed, so stop splitting there
+    profile_raw_info = PROFILE_REGION_RE.split(vendor_raw_html, 2)
+    profile_raw_info_2 = profile_raw_info[1]
+
+    review_raw_info = REVIEW_TABLE_RE.split(vendor_raw_html, 2)
+    review_raw_info_2 = None
+    if len(review_raw_info) > 1:
+        review_raw_info_2 = review_raw_info[1]
+
+    return (profile_raw_info_2, review_raw_info_2)
 
-            review_raw_info = re.split('<table class="zebra"><tr><th>rating</th><th>review</th><th>freshness</th><th>item</th>', vendor_raw_html)
-            reviews = ""
-            if len(review_raw_info) > 1:
-                review_raw_info_2 = review_raw_info[1]
+# Same as split_page_regions, but finds the markers in the raw bytes of a memory-mapped
+# file and only decodes the two regions; the listing tables are never decoded or copied.
+def read_page_regions_mmap(filepath_full):
+    with open(filepath_full, "rb") as vendor_file:
+        if os.fstat(vendor_file.fileno()).st_size is 0:
+            # an empty file can't be mapped, and has no markers anyway
+            return split_page_regions(u"")
+        page = mmap.mmap(vendor_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return split_page_regions_bytes(page)
+        finally:
+            page.close()
 
-                review_list = scrape_reviews(review_raw_info_2)
-                reviews = review_list_to_string(review_list)
-            else:
-                review_list = []
+def split_page_regions_bytes(page):
+    profile_region = find_region_bytes(PROFILE_REGION_RE, page)
+    if profile_region is None:
+        # no profile on this page, fail the way split_page_regions does
+        raise IndexError("list index out of range")
+    profile_raw_info_2 = profile_region.decode("utf-8")
 
-            (username, duration, rank, feedback, transactions, fans, profile) = scrape_profile(profile_scraped)
-            #break
+    review_raw_info_2 = None
+    review_region = find_region_bytes(REVIEW_TABLE_RE, page)
+    if review_region is not None:
+        review_raw_info_2 = review_region.decode("utf-8")
 
-            profile = h.unescape(profile)
-            profile = profile.replace('\\', '')
+    return (profile_raw_info_2, review_raw_info_2)
 
-         #   print profile
+# the bytes between the first and second match of pattern (or the end of page)
+def find_region_bytes(pattern, page):
+    first = pattern.search(page)
+    if first is None:
+        return None
+    second = pattern.search(page, first.end())
+    if second is None:
+        return page[first.end():]
+    return page[first.end():second.start()]
 
-            vendor_id = filename.split('.')[0]
-            vendor = Vendor(username, vendor_id, duration, rank, feedback, transactions, fans, profile, reviews, review_list)
+def scrape_vendor(filename, profile_raw_info_2, review_raw_info_2, scraper):
+    h = HTMLParser()
+
+    if scraper == "fast":
+        (username, duration, rank, feedback, transactions, fans, profile) = scrape_profile_fast(profile_raw_info_2)
+    else:
+        profile_scraped = re.split("<[^<>]*>", profile_raw_info_2)
+        (username, duration, rank, feedback, transactions, fans, profile) = scrape_profile(profile_scraped)
+
+    reviews = ""
+    if review_raw_info_2 is not None:
+        review_list = scrape_reviews(review_raw_info_2)
+        reviews = review_list_to_string(review_list)
+    else:
+        review_list = []
 
-            vendors.append(vendor)
-          
-    return vendors
+    #break
+
+    profile = h.unescape(profile)
+    profile = profile.replace('\\', '')
+
+ #   print profile
+
+    vendor_id = filename.split('.')[0]
+    return Vendor(username, vendor_id, duration, rank, feedback, transactions, fans, profile, reviews, review_list)
 
 def scrape_reviews(reviews_scraped):
+    return list(iter_reviews(reviews_scraped))
+
+# yields the (rating, message) pairs scrape_reviews returns, in one pass over the table
+def iter_reviews(reviews_scraped):
     h = HTMLParser()
-    reviews_1 = re.split("</tr><tr>", reviews_scraped)
-    reviews_2 = []
-    for each in reviews_1:
-        each_2 = re.split("<[^>]*>", each)
-        for each_3 in each_2:
-            reviews_2.append(each_3)
-            
-    reviews_3 = []
-    for each in reviews_2:
-        if each is u"":
-            pass
-        elif "\t" in each:
-            pass
-        elif "\n" in each:
-            pass
-        else:
-            reviews_3.append(each)
-            
+    cells = iter_review_cells(reviews_scraped)
+
     t = 0
-    
-    review_table = []
-    
+    each = next(cells, None)
+
     #Consolidate the reviews
-    for each in reviews_3:
+    while each is not None:
+        following = next(cells, None)
         if "community forums" in each or "wiki" in each or "|" in each or "support" in each:
             break
-        if "&nbsp" in reviews_3[t+1]:
+        # the old list version raised IndexError here; a table without a footer just ends
+        if following is None:
+            break
+        if "&nbsp" in following:
             break
         if t % 4 is 0:
             #rating = each.split(" of ")[0]
             try:
                 rating = int(each[0])
-                message = reviews_3[t + 1]
-                
-                message = h.unescape(message)
-                
-                review_table.append((rating, message))
-                
+                message = h.unescape(following)
+                yield (rating, message)
             except ValueError:
                 #print each
                 pass
             except IndexError:
                 #print each
                 pass
-        if each is not '':
-            t = t + 1
-    return review_table
-    
+        each = following
+        t = t + 1
+
+# the table cells scrape_reviews looks at: split into rows, then on tags, 
+# skipping empty cells and cells with tabs or newlines (layout whitespace)
+def iter_review_cells(reviews_scraped):
+    for row in iter_split(REVIEW_ROW_RE, reviews_scraped):
+        for cell in iter_split(REVIEW_TAG_RE, row):
+            if len(cell) is 0 or "\t" in cell or "\n" in cell:
+                continue
+            yield cell
+
 def review_list_to_string(review_list):
-    reviews = u""
-    for review in review_list:
-        reviews = reviews + review[1] + " " + str(review[0]) + "\n"
-        h = HTMLParser()
-        reviews = h.unescape(reviews)
+    # This used to unescape the whole string again after adding each review, so 
+    # review i of n was unescaped n - i times. Entities can't reach across the 
+    # " rating\n" between reviews, so each review is unescaped on its own that 
+    # many times, stopping early once unescaping no longer changes it.
+    h = HTMLParser()
+    review_count = len(review_list)
+    reviews = []
+    for i in range(review_count):
+        review = review_list[i]
+        review_string = review[1] + " " + str(review[0]) + "\n"
+        for j in range(review_count - i):
+            unescaped = h.unescape(review_string)
+            if unescaped == review_string:
+                break
+            review_string = unescaped
+        reviews.append(review_string)
         
-    return reviews
+    return u"".join(reviews)
     
 def scrape_profile(profile_scraped):
     username, duration, rank, feedback, transactions, fans, profile_scraped_string = "", "", "", "", "", "", u""
@@ -278,3 +540,102 @@ def scrape_profile(profile_scraped):
     #FIX THIS THING
     
     return (username, months, rank, feedback, transactions, fans, pss2)
+
+# yields the same pieces as pattern.split(text), one at a time
+def iter_split(pattern, text):
+    position = 0
+    for match in pattern.finditer(text):
+        yield text[position:match.start()]
+        position = match.end()
+    yield text[position:]
+
+# Does what scrape_profile does to re.split("<[^<>]*>", profile_html), with the same
+# results, but reads the pieces lazily and stops at "category" instead of building lists.
+def scrape_profile_fast(profile_html):
+    username, duration, rank, feedback, transactions, fans = "", "", "", "", "", ""
+    profile_parts = []
+
+    prev_item = None
+    in_profile = False
+
+    dur_found, trans_found, rank_found, fans_found, feed_found = False, False, False, False, False
+
+    for item in iter_split(PROFILE_TAG_RE, profile_html):
+        # scrape_profile drops empty and whitespace-only pieces up front
+        if len(item) is 0 or item.isspace():
+            continue
+
+        if u"category" in item:
+            break
+
+        if prev_item is None:
+            username = item
+
+        elif not dur_found and "has been a vendor for" in prev_item:
+            duration = item
+            dur_found = True
+
+        elif not rank_found and "ranked in the" in prev_item:
+            for each in RANK_SPLIT_RE.split(item):
+                if len(each) > 0:
+                    rank = each
+                    try:
+                        rank = float(rank)
+                    except:
+                        print rank, type(rank), username
+                    break
+            rank_found = True
+
+        elif not feed_found and "with" in prev_item:
+            # scrape_profile keeps whatever comes before the first "%", even if it is empty
+            feedback = item.split("%", 1)[0]
+            try:
+                feedback = float(feedback)
+            except:
+                print feedback, type(feedback), username
+            feed_found = True
+
+        elif not trans_found and item == " transactions":
+            transactions = prev_item
+            if "more than " in transactions:
+                transactions = transactions.split("more than ")[1]
+            try:
+                transactions = float(transactions)
+            except:
+                print transactions, type(transactions), username
+            trans_found = True
+
+        elif not fans_found and item == " fans - ":
+            fans = prev_item
+            try:
+                fans = float(fans)
+            except:
+                print fans, type(fans)
+            fans_found = True
+
+        elif in_profile or "report this vendor" in prev_item:
+            in_profile = True
+            profile_parts.append(item)
+
+        prev_item = item
+
+    pss2 = u"".join(profile_parts).replace(".\n", ". ")
+    pss2 = pss2.replace("\n", " ")
+    pss2 = pss2.replace(u"\u2013", "-")
+    pss2 = pss2.replace(u"\u00b4", "'")
+
+    # same as re.sub(PGP_BEGIN + ".+" + PGP_END, "", pss2): there are no newlines left,
+    # so the greedy match runs from the first BEGIN to the last "K-----" after it
+    begin = pss2.find(PGP_BEGIN)
+    if begin != -1:
+        end = pss2.rfind(PGP_END)
+        if end > begin + len(PGP_BEGIN):
+            pss2 = pss2[:begin] + pss2[end + len(PGP_END):]
+
+    months, unit = duration.split(" ")
+    if "year" in unit:
+        months = int(months)*12
+    if months is 0:
+        months = 1
+
+    return (username, months, rank, feedback, transactions, fans, pss2)
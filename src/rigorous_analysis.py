@@ -4,11 +4,13 @@
 
 import re
 
-import nltk, codecs, json
+import codecs, json, itertools, multiprocessing, hashlib
 
-from spacycaller import SpacyCaller
+from spacycaller import SpacyCaller, DocCache
+from lexicon import LexiconMatcher
 from parse_vendors import Vendor
-from vaderSentiment.vaderSentiment import sentiment as vaderSentiment
+from sentiment_cache import SentimentCache
+import timing
 
 class Analysis:
 
@@ -28,6 +30,10 @@ class Analysis:
         self.profile_sentiments = profile_sentiments
         self.review_sentiments = review_sentiments
 
+        # what the features were worked out from, see Analyzer.reanalyze_many
+        self.content_hash = None
+        self.feature_versions = {}
+
         self.fans = fans
         self.rank = rank
         self.transactions = transactions
@@ -50,6 +56,13 @@ class Analysis:
         
         return param_tuple
 
+    # The features this analysis has values for: those in feature_versions, or every one 
+    # for analyses made before content_hash and feature_versions were kept.
+    def computed_features(self):
+        if self.content_hash is None:
+            return set(FEATURE_COMPONENTS)
+        return set(self.feature_versions)
+
     def flatten(self):
         feedback = 0
         months = 1
@@ -68,56 +81,73 @@ class Analysis:
         transactions = self.transactions
         fans = self.fans
 
-        pc = self.pos_counts
-
-        q = self.quantity               # 4
-
-        word_count = q[0]
-        np_count = q[1]
-        sentence_count = q[2]
-        verb_count = pc[0]
-
-        c = self.complexity             # 5
-        avg_num_of_clauses = c[0]
-        avg_sentence_length = c[1]
-        avg_word_length = c[2]
-        avg_length_np = c[3]
-        pausality = c[4]
-
-        u = self.uncertainty            # 3
-        uncertainty_count = float(u[0])
-        other_ref = u[1]
-        modal_count = pc[4]
-
-        d = self.diversity              # 2
-        lex_d = d[0]
-        con_d = d[1]
-
-        n = self.nonimmediacy           # 2
-
-        if word_count is 0:
-            self_ref, group_ref = 0,0
-        else:
-            self_ref = n[0]*1.0 / word_count
-            group_ref = n[1]*1.0 / word_count
-
-        e = self.emotiveness            # 1 
-
-        ps = self.profile_sentiments    # 5
-        ppos = ps["pos"]
-        pneg = ps["neg"]
-        pneu = ps["neu"]
-        pcom = ps["compound"]
-
-        rs, rpos, rneg, rneu, rcom = 0,0,0,0,0
-        rs_both = self.review_sentiments     # 4
-        if rs_both is not None:
-            avg_rating = rs_both[0]
-            rs = rs_both[1]
-            rpos = rs["pos"]
-            rneg = rs["neg"]
-            rneu = rs["neu"]
-            rcom = rs["compound"]
+        # features this analysis hasn't worked out yet flatten to None
+        computed = self.computed_features()
+        word_count, np_count, sentence_count, verb_count, modal_count = None, None, None, None, None
+        avg_num_of_clauses, avg_sentence_length, avg_word_length, avg_length_np, pausality = None, None, None, None, None
+        uncertainty_count, other_ref, lex_d, con_d, self_ref, group_ref, e = None, None, None, None, None, None, None
+        ppos, pneg, pneu, pcom = None, None, None, None
+        rpos, rneg, rneu, rcom = None, None, None, None
+
+        if "pos_counts" in computed:
+            pc = self.pos_counts
+            verb_count = pc[0]
+            modal_count = pc[4]
+
+        if "quantity" in computed:
+            q = self.quantity               # 4
+
+            word_count = q[0]
+            np_count = q[1]
+            sentence_count = q[2]
+
+        if "complexity" in computed:
+            c = self.complexity             # 5
+            avg_num_of_clauses = c[0]
+            avg_sentence_length = c[1]
+            avg_word_length = c[2]
+            avg_length_np = c[3]
+            pausality = c[4]
+
+        if "uncertainty" in computed:
+            u = self.uncertainty            # 3
+            uncertainty_count = float(u[0])
+            other_ref = u[1]
+
+        if "diversity" in computed:
+            d = self.diversity              # 2
+            lex_d = d[0]
+            con_d = d[1]
+
+        if "nonimmediacy" in computed and "quantity" in computed:
+            n = self.nonimmediacy           # 2
+
+            if word_count is 0:
+                self_ref, group_ref = 0,0
+            else:
+                self_ref = n[0]*1.0 / word_count
+                group_ref = n[1]*1.0 / word_count
+
+        if "emotiveness" in computed:
+            e = self.emotiveness            # 1 
+
+        if "profile_sentiments" in computed:
+            ps = self.profile_sentiments    # 5
+            ppos = ps["pos"]
+            pneg = ps["neg"]
+            pneu = ps["neu"]
+            pcom = ps["compound"]
+
+        if "review_sentiments" in computed:
+            rs, rpos, rneg, rneu, rcom = 0,0,0,0,0
+            rs_both = self.review_sentiments     # 4
+            if rs_both is not None:
+                avg_rating = rs_both[0]
+                rs = rs_both[1]
+                rpos = rs["pos"]
+                rneg = rs["neg"]
+                rneu = rs["neu"]
+                rcom = rs["compound"]
                                                 # 23 = total 
 
         flat_tuple = (feedback, months, rank, fans, transactions, word_count, sentence_count, np_count, verb_count, 
@@ -135,25 +165,190 @@ class Analysis:
                 "rneu": rneu, "rcom": rcom}
         return flat_dict, flat_tuple
 
+class FlatAnalysis(Analysis):
+    """ An analysis read back from the column store: only the flattened attributes are kept,
+    which is all the networks and trust.py need. """
+    def __init__(self, vendor_id, username, flat_dict):
+        self.vendor_id = vendor_id
+        self.username = username
+        self.flat_dict = flat_dict
+
+        self.fans = flat_dict["fans"]
+        self.rank = flat_dict["rank"]
+        self.transactions = flat_dict["transactions"]
+        self.feedback = flat_dict["feedback"]
+        self.months = flat_dict["months"]
+
+    def flatten(self):
+        flat_tuple = tuple(self.flat_dict[attr] for attr in self.flat_attributes)
+        return dict(self.flat_dict), flat_tuple
+
+# The spaCy components each feature needs. uncertainty and nonimmediacy only count strings 
+# in the profile, and the sentiments score it with VADER, so none of them need spaCy at all; 
+# nothing uses named entities.
+FEATURE_COMPONENTS = {"quantity": ["tagger", "parser"], "pos_counts": ["tagger"], "complexity": ["tagger", "parser"],
+    "uncertainty": None, "nonimmediacy": None, "emotiveness": ["tagger"], "diversity": ["tagger"],
+    "profile_sentiments": None, "review_sentiments": None}
+
+# (whether the features need a Doc at all, the components they need)
+def needed_components(features):
+    needs_doc = False
+    components = set()
+    for feature in features:
+        if FEATURE_COMPONENTS[feature] is not None:
+            needs_doc = True
+            components.update(FEATURE_COMPONENTS[feature])
+    return (needs_doc, components)
+
+# Bump a feature's version whenever its code changes, so reanalyze_many knows to work it
+# out again. uncertainty and nonimmediacy also change with their lexicons.
+FEATURE_VERSIONS = {"quantity": 1, "pos_counts": 1, "complexity": 1, "uncertainty": 1, "nonimmediacy": 1,
+    "emotiveness": 1, "diversity": 1, "profile_sentiments": 1, "review_sentiments": 1}
+
+FEATURE_LEXICONS = {"uncertainty": ["uncertainty", "other_reference"], "nonimmediacy": ["self_reference", "group_reference"]}
+
+# features worked out from other features' values, which go stale along with them
+FEATURE_INPUTS = {"emotiveness": ["pos_counts"]}
+
+# The features each of Analysis.flat_attributes is flattened from; the vendor's own details
+# need none. self_ref and group_ref are per word, so they need the word count too.
+ATTRIBUTE_FEATURES = {"feedback": [], "months": [], "rank": [], "fans": [], "transactions": [],
+    "word_count": ["quantity"], "sentence_count": ["quantity"], "np_count": ["quantity"],
+    "verb_count": ["pos_counts"], "modal_count": ["pos_counts"],
+    "avg_num_of_clauses": ["complexity"], "avg_sentence_length": ["complexity"], "avg_word_length": ["complexity"],
+    "avg_length_np": ["complexity"], "pausality": ["complexity"],
+    "uncertainty_count": ["uncertainty"], "other_ref": ["uncertainty"],
+    "lex_d": ["diversity"], "con_d": ["diversity"],
+    "self_ref": ["nonimmediacy", "quantity"], "group_ref": ["nonimmediacy", "quantity"], "e": ["emotiveness"],
+    "ppos": ["profile_sentiments"], "pneg": ["profile_sentiments"], "pneu": ["profile_sentiments"], "pcom": ["profile_sentiments"],
+    "rpos": ["review_sentiments"], "rneg": ["review_sentiments"], "rneu": ["review_sentiments"], "rcom": ["review_sentiments"]}
+
+# the features needed to flatten attrs, including the ones those features are worked out from
+def features_for_attributes(attrs):
+    features = set()
+    for attr in attrs:
+        features.update(ATTRIBUTE_FEATURES[attr])
+    for feature in list(features):
+        if feature in FEATURE_INPUTS:
+            features.update(FEATURE_INPUTS[feature])
+    return features
+
+# a hash of everything the features are worked out from
+def content_hash(vendor):
+    return hashlib.sha1(json.dumps([vendor.profile, vendor.reviews])).hexdigest()
+
+lexicon_matcher = LexiconMatcher()
+# every VADER score in this process goes through here
+sentiment_cache = SentimentCache()
+
 class Analyzer:
-    def __init__(self):
-        self.spacy = SpacyCaller()
+    """ Analyzes vendors for features (all of FEATURE_COMPONENTS by default), running only
+    the spaCy components those need on the process's one model (see spacycaller.get_model).
+    Features that weren't asked for are None in the Analysis, unless they came for free with
+    one that was. lexicons replaces any of the word lists uncertainty and nonimmediacy count
+    (see lexicon.LEXICONS). doc_cache names an SQLite file of parsed Docs to read profiles from
+    before parsing them again. """
+    def __init__(self, features=None, lexicons=None, doc_cache=None):
+        if features is None:
+            features = FEATURE_COMPONENTS.keys()
+        self.features = set(features)
+        (self.needs_doc, self.components) = needed_components(self.features)
+        self.doc_cache = doc_cache
+        if self.needs_doc:
+            cache = None
+            if doc_cache is not None:
+                cache = DocCache(doc_cache)
+            self.spacy = SpacyCaller(tagger="tagger" in self.components, parser="parser" in self.components, entity=False, doc_cache=cache)
+        else:
+            self.spacy = None
+        self.lexicons = lexicons
+        if lexicons is None:
+            self.lexicon_matcher = lexicon_matcher
+        else:
+            self.lexicon_matcher = LexiconMatcher(lexicons)
+
+        self.feature_versions = {}
+        for feature in self.features:
+            version = str(FEATURE_VERSIONS[feature])
+            if feature in FEATURE_LEXICONS:
+                version += "/" + self.lexicon_matcher.digest(FEATURE_LEXICONS[feature])
+            self.feature_versions[feature] = version
+        # Analyzers for just some of the features, for reanalyze_many
+        self.partial_analyzers = {}
         
-    def analyze(self, vendor):
-
+    # With attrs (names from Analysis.flat_attributes), only the features those need are 
+    # worked out; complete() fills in the rest later.
+    def analyze(self, vendor, attrs=None):
+        if attrs is not None:
+            return self.partial_analyzer(frozenset(features_for_attributes(attrs))).analyze(vendor)
+
+        if self.spacy is None:
+            return self.analyze_tokens(vendor, None)
         tokens = self.spacy.spacy_analyze_vendor(vendor)
-    
-        pos_count_tuple = pos_counts(tokens)
-        quantity = quantity_analysis(tokens)
-        complexity = complexity_analysis(tokens, vendor)
-        uncertainty = uncertainty_analysis(tokens)
-        nonimmediacy = nonimmediacy_analysis(tokens)
-        emotiveness = emotiveness_analysis(pos_count_tuple)
-        diversity = diversity_analysis(tokens)
+        return self.analyze_tokens(vendor, tokens)
+
+    # analyses for each vendor, in order; spaCy parses the profiles batch_size at a time,
+    # which costs a lot less per profile than parsing them one by one
+    def analyze_many(self, vendors, batch_size=1000, attrs=None):
+        if attrs is not None:
+            for analysis in self.partial_analyzer(frozenset(features_for_attributes(attrs))).analyze_many(vendors, batch_size):
+                yield analysis
+            return
+
+        vendors = iter(vendors)
+        while True:
+            batch = list(itertools.islice(vendors, batch_size))
+            if len(batch) is 0:
+                break
+
+            if "review_sentiments" in self.features:
+                started = timing.start()
+                review_sentiments = review_sentiment_batch(batch)
+                timing.stop("review_sentiment_batch", started)
+            else:
+                review_sentiments = [None] * len(batch)
 
-        profile_sentiments = profile_sentiment_analysis(vendor)
+            if self.spacy is None:
+                docs = [None] * len(batch)
+            else:
+                docs = (tokens for (vendor, tokens) in self.spacy.spacy_analyze_vendors(batch, batch_size))
 
-        review_sentiments = review_sentiment_analysis(vendor)
+            for (vendor, tokens, rs) in itertools.izip(batch, docs, review_sentiments):
+                yield self.analyze_tokens(vendor, tokens, rs)
+
+    # review_sentiments, if it's already been worked out for vendor, isn't scored again
+    def analyze_tokens(self, vendor, tokens, review_sentiments=None):
+        features = self.features
+        analysis_started = timing.start()
+    
+        quantity, pos_count_tuple, complexity, diversity = None, None, None, None
+        if "tagger" in self.components:
+            started = timing.start()
+            (quantity, pos_count_tuple, complexity, diversity) = token_features(tokens, "parser" in self.components)
+            timing.stop("token_features", started)
+
+        uncertainty, nonimmediacy, emotiveness = None, None, None
+        if "uncertainty" in features or "nonimmediacy" in features:
+            # one scan of the profile counts every lexicon; it's the same text the Doc has
+            started = timing.start()
+            counts = self.lexicon_matcher.counts(vendor.profile)
+            timing.stop("lexicon_counts", started)
+            if "uncertainty" in features:
+                uncertainty = uncertainty_analysis(tokens, counts)
+            if "nonimmediacy" in features:
+                nonimmediacy = nonimmediacy_analysis(tokens, counts)
+        if "emotiveness" in features:
+            emotiveness = emotiveness_analysis(pos_count_tuple)
+
+        profile_sentiments = None
+        if "profile_sentiments" in features:
+            started = timing.start()
+            profile_sentiments = profile_sentiment_analysis(vendor)
+            timing.stop("profile_sentiment_analysis", started)
+        if "review_sentiments" in features and review_sentiments is None:
+            started = timing.start()
+            review_sentiments = review_sentiment_analysis(vendor)
+            timing.stop("review_sentiment_analysis", started)
         
  
         fans = vendor.fans
@@ -164,24 +359,226 @@ class Analyzer:
         username = vendor.username
         rank = vendor.rank
 
-        return Analysis(fans, transactions, feedback, rank, months, vendor_id, username, quantity, pos_count_tuple, complexity, uncertainty, nonimmediacy, emotiveness, diversity, profile_sentiments, review_sentiments)
+        analysis = Analysis(fans, transactions, feedback, rank, months, vendor_id, username, quantity, pos_count_tuple, complexity, uncertainty, nonimmediacy, emotiveness, diversity, profile_sentiments, review_sentiments)
+        analysis.content_hash = content_hash(vendor)
+        analysis.feature_versions = dict(self.feature_versions)
+        # everything but the spaCy parse and batched review scoring
+        timing.stop("analyze_tokens", analysis_started)
+        return analysis
+
+    # The features of previous (an earlier Analysis of vendor, or None) that have to be worked 
+    # out again: all of them if the profile or reviews changed, otherwise those whose version did.
+    def stale_features(self, vendor, previous):
+        if previous is None or getattr(previous, "content_hash", None) != content_hash(vendor):
+            return set(self.features)
+        versions = getattr(previous, "feature_versions", {})
+        stale = set()
+        for feature in self.features:
+            if versions.get(feature) != self.feature_versions[feature]:
+                stale.add(feature)
+        for feature in self.features:
+            if feature in FEATURE_INPUTS and len(stale.intersection(FEATURE_INPUTS[feature])) > 0:
+                stale.add(feature)
+        return stale
+
+    # Analyses for the vendors whose analysis in previous ({vendor id: Analysis}) is missing
+    # or out of date, in the order of the vendors. Only the stale features are worked out 
+    # again; the rest are kept from previous. Vendors whose analysis is up to date are skipped.
+    def reanalyze_many(self, vendors, previous, batch_size=1000):
+        vendors = iter(vendors)
+        while True:
+            batch = list(itertools.islice(vendors, batch_size))
+            if len(batch) is 0:
+                break
+
+            # vendors with the same stale features are analyzed together
+            groups = {}
+            for k in range(len(batch)):
+                stale = frozenset(self.stale_features(batch[k], previous.get(batch[k].id)))
+                groups.setdefault(stale, []).append(k)
+                if len(stale) is 0:
+                    timing.count("vendors_up_to_date")
+
+            results = [None] * len(batch)
+            for (stale, indices) in groups.items():
+                vendor_group = [batch[k] for k in indices]
+                if len(stale) is 0:
+                    for k in indices:
+                        results[k] = self.merge(batch[k], None, previous[batch[k].id], stale)
+                    continue
+                analyzer = self.partial_analyzer(stale)
+                for (k, analysis) in itertools.izip(indices, analyzer.analyze_many(vendor_group, batch_size)):
+                    results[k] = self.merge(batch[k], analysis, previous.get(batch[k].id), stale)
+
+            for analysis in results:
+                if analysis is not None:
+                    yield analysis
+
+    # Works out whichever of the features attrs need (all of this Analyzer's, without attrs)
+    # that analysis, an Analysis of vendor, doesn't have yet, and adds them to it.
+    def complete(self, analysis, vendor, attrs=None):
+        if attrs is None:
+            needed = set(self.features)
+        else:
+            needed = features_for_attributes(attrs)
+        needed = needed - analysis.computed_features()
+        if len(needed) is 0:
+            return analysis
+
+        partial = self.partial_analyzer(frozenset(needed)).analyze(vendor)
+        for feature in needed:
+            setattr(analysis, feature, getattr(partial, feature))
+            analysis.feature_versions[feature] = partial.feature_versions[feature]
+        analysis.content_hash = partial.content_hash
+        return analysis
+
+    def partial_analyzer(self, features):
+        if features == self.features:
+            return self
+        if features not in self.partial_analyzers:
+            self.partial_analyzers[features] = Analyzer(features, self.lexicons, self.doc_cache)
+        return self.partial_analyzers[features]
+
+    # analysis's values for the stale features and previous's for the rest, or None when 
+    # nothing stale and vendor's details haven't changed either
+    def merge(self, vendor, analysis, previous, stale):
+        if previous is None or stale == set(FEATURE_COMPONENTS):
+            return analysis
+        details = ["fans", "transactions", "feedback", "rank", "months", "username"]
+        if len(stale) is 0 and [getattr(previous, name) for name in details] == [getattr(vendor, name) for name in details]:
+            return None
+
+        values = {}
+        for feature in FEATURE_COMPONENTS:
+            if feature in stale:
+                values[feature] = getattr(analysis, feature)
+            else:
+                values[feature] = getattr(previous, feature)
+        merged = Analysis(vendor.fans, vendor.transactions, vendor.feedback, vendor.rank, vendor.months, vendor.id, vendor.username, 
+            values["quantity"], values["pos_counts"], values["complexity"], values["uncertainty"], values["nonimmediacy"], 
+            values["emotiveness"], values["diversity"], values["profile_sentiments"], values["review_sentiments"])
+        merged.content_hash = content_hash(vendor)
+        if getattr(previous, "content_hash", None) == merged.content_hash:
+            merged.feature_versions = dict(getattr(previous, "feature_versions", {}))
+        else:
+            # what's kept from previous was worked out from other text, so only the
+            # features worked out again below count as computed
+            merged.feature_versions = {}
+        for feature in stale:
+            merged.feature_versions[feature] = self.feature_versions[feature]
+        return merged
     
     def __str__(self):
         return self.__dict__
 
     
 
+# the Analyzer each AnalyzerPool worker process loads for itself when it starts
+worker_analyzer = None
+
+def init_analyzer_worker(features, lexicons, doc_cache):
+    global worker_analyzer
+    timing.reset()
+    sentiment_cache.reset()
+    worker_analyzer = Analyzer(features, lexicons, doc_cache)
+
+# Each chunk's analyses come back with what the worker's sentiment_cache recorded meanwhile,
+# so the parent's has every hit, miss and new score to report and save.
+def analyze_chunk(vendors):
+    analyses = list(worker_analyzer.analyze_many(vendors))
+    return (analyses, sentiment_cache.take())
+
+def reanalyze_chunk(chunk):
+    (vendors, previous) = chunk
+    analyses = list(worker_analyzer.reanalyze_many(vendors, previous))
+    return (analyses, sentiment_cache.take())
+
+class AnalyzerPool:
+    """ Analyzes vendors on jobs processes, each with its own Analyzer (and so its own spaCy 
+    model), handing them chunk_size vendors at a time. analyze_many gives the analyses back in 
+    the order of the vendors. With jobs=1 it's just an Analyzer in this process. """
+    def __init__(self, jobs=1, features=None, chunk_size=64, lexicons=None, doc_cache=None):
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        if jobs > 1:
+            self.analyzer = None
+            self.pool = multiprocessing.Pool(jobs, init_analyzer_worker, (features, lexicons, doc_cache))
+        else:
+            self.analyzer = Analyzer(features, lexicons, doc_cache)
+            self.pool = None
+
+    def analyze(self, vendor):
+        return list(self.analyze_many([vendor]))[0]
+
+    def analyze_many(self, vendors):
+        if self.pool is None:
+            return self.analyzer.analyze_many(vendors)
+        return self.map_chunks(analyze_chunk, self.iter_chunks(vendors))
+
+    # Analyzer.reanalyze_many, spread over the pool the same way
+    def reanalyze_many(self, vendors, previous):
+        if self.pool is None:
+            return self.analyzer.reanalyze_many(vendors, previous)
+        chunks = ((chunk, dict((vendor.id, previous[vendor.id]) for vendor in chunk if vendor.id in previous)) 
+            for chunk in self.iter_chunks(vendors))
+        return self.map_chunks(reanalyze_chunk, chunks)
+
+    def iter_chunks(self, vendors):
+        vendors = iter(vendors)
+        while True:
+            chunk = list(itertools.islice(vendors, self.chunk_size))
+            if len(chunk) is 0:
+                break
+            yield chunk
+
+    def map_chunks(self, function, chunks):
+        # the workers' timings come back with their analyses
+        if timing.enabled:
+            function = timing.Collecting(function)
+        # a window of chunks at a time, so vendors aren't read in much faster than the
+        # analyses are used; pool.map keeps the chunks in order
+        window = self.jobs * 4
+        while True:
+            window_chunks = list(itertools.islice(chunks, window))
+            if len(window_chunks) is 0:
+                break
+            results = self.pool.map(function, window_chunks, 1)
+            if timing.enabled:
+                results = timing.collect_results(results)
+            for (analyses, sentiments) in results:
+                sentiment_cache.merge(sentiments)
+                for analysis in analyses:
+                    yield analysis
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            self.pool.terminate()
+        self.close()
+
 def create_Analysis_from_json(jsons):
-    a = json.loads(jsons)
-    
+    return create_Analysis_from_dict(json.loads(jsons))
+
+def create_Analysis_from_dict(a):
     analysis = Analysis(a["fans"], a["transactions"], a["feedback"], a["rank"], a["months"], a["vendor_id"],
     a["username"], a["quantity"], a["pos_counts"], a["complexity"], a["uncertainty"],
     a["nonimmediacy"], a["emotiveness"], a["diversity"], a["profile_sentiments"], a["review_sentiments"])
+    # analyses written before these were kept are out of date for every feature
+    analysis.content_hash = a.get("content_hash")
+    analysis.feature_versions = a.get("feature_versions", {})
     return analysis
 
+content_POS_list = ["FW", "JJ", "JJR", "JJS", "NN", "MD", "NNP", "NNPS", "NNS", "RB", "RBR", "RP", "UH", "VB", "VBD", "VBG", "VBN", "VBP", "VBZ", "SYM"]
+
 def get_content_words(tokens):
-    content_POS_list = ["FW", "JJ", "JJR", "JJS", "NN", "MD", "NNP", "NNPS", "NNS", "RB", "RBR", "RP", "UH", "VB", "VBD", "VBG", "VBN", "VBP", "VBZ", "SYM"]
-    
     content_words = []
     for token in tokens:
         pos = token.tag_
@@ -204,35 +601,54 @@ def frequencies(tokens):
 def profile_sentiment_analysis(vendor):
     profile = vendor.profile
     profile = profile.encode(errors="ignore")
-    vs = vaderSentiment(profile)
+    vs = sentiment_cache.sentiment(profile)
 
     return vs
 
 def review_sentiment_analysis(vendor):
-    review_list = vendor.reviews
+    return review_sentiment_batch([vendor])[0]
+
+# review_sentiment_analysis for each vendor. The messages of every review in the batch are
+# looked up in sentiment_cache together, and the ones it doesn't have are scored together by
+# vader_batch, which tokenizes each once against the lexicon it has already loaded.
+def review_sentiment_batch(vendors):
+    messages = []
+    for vendor in vendors:
+        for review in vendor.reviews:
+            messages.append(review[1].encode(errors="ignore"))
+    scores = sentiment_cache.sentiment_many(messages)
+
+    results = []
+    k = 0
+    for vendor in vendors:
+        review_list = vendor.reviews
+        results.append(aggregate_review_sentiments(review_list, scores[k:k + len(review_list)]))
+        k += len(review_list)
+    return results
+
+# (average rating, average VADER scores) over review_list, given each review's scores
+def aggregate_review_sentiments(review_list, scores):
     rating_sum = 0.0
     num_ratings = 0.0
     
     if len(review_list) is 0:
         return None
     
-    sent_sum = {"pos":0.0, "neg":0.0, "neu":0.0, "compound":0.0}
-    for review in review_list:
-        message = review[1]
-        message = message.encode(errors="ignore")
+    pos_sum, neg_sum, neu_sum, compound_sum = 0.0, 0.0, 0.0, 0.0
+    for (review, vs) in itertools.izip(review_list, scores):
         rating = review[0]
-
-        vs = vaderSentiment(message)
         
         if not (vs["neu"] is 1.0 and vs["compound"] is 0.0):
-            for key in vs.keys():
-                sent_sum[key] += float(vs[key])
+            pos_sum += float(vs["pos"])
+            neg_sum += float(vs["neg"])
+            neu_sum += float(vs["neu"])
+            compound_sum += float(vs["compound"])
                 
             rating_sum += float(rating)
             num_ratings += 1
         
-    for key in sent_sum.keys():
-        sent_sum[key] = sent_sum[key] / num_ratings
+    sent_sum = {"pos": pos_sum / num_ratings, "neg": neg_sum / num_ratings, 
+        "neu": neu_sum / num_ratings, "compound": compound_sum / num_ratings}
         
     return (rating_sum/num_ratings, sent_sum)    
     
@@ -314,47 +730,91 @@ def complexity_analysis(tokens, vendor):
     
     return complexity
     
-def uncertainty_analysis(tokens):
-    uncertain_words = ["appear", "Appear",
-    "seem", "Seem",
-    "suggest", "Suggest",
-    "indicat", "Indicat",
-    "assum", "Assum",        
-    "imply", "implie", "Imply", "Implie",
-    "hope", "Hope", "hoping", "Hoping",
-    "Think so", "think so"]
-    
-    txt = tokens.text
-    uncertainty_count = 0
-    for word in uncertain_words:
-        uncertainty_count += txt.count(word)
-        
-    other_reference_words = [" he ", "He ", " she ", "She ",
-        " him.", " him,", " him ", "himself",
-        " her.", " her,", " her ", "herself",
-        "It ", " it ", " it.", " it ", " itself ",
-        " they", "They", "Them", "them",
-        ]                
-    
-    other_reference_count = 0
-    for word in other_reference_words:
-        other_reference_count += txt.count(word)
+# quantity_analysis, pos_counts, complexity_analysis and diversity_analysis all at once, 
+# with the same results, walking the tokens once and noun_chunks and sents once each. 
+# Without the parse (parsed=False) quantity and complexity come back None.
+def token_features(tokens, parsed=True):
+    verb_count, noun_count, adj_count, adv_count, modal_count = 0,0,0,0,0
+    clause_count = 0
+    character_count = 0
+    punct_count = 0.0
+    unique_tokens = set()
+    content_count = 0
+    unique_contents = set()
+    content_POS = set(content_POS_list)
+
+    for token in tokens:
+        tag = token.tag_
+        pos = token.pos_
+        text = token.text
+
+        if "MD" in tag:
+            modal_count += 1
+        elif "JJ" in tag:
+            adj_count += 1
+        elif "RB" in tag:
+            adv_count += 1
+        elif "NOUN" in pos:
+            noun_count += 1
+        elif "VERB" in pos:
+            verb_count += 1
+
+        if "VERB" in pos:
+            if token is token.head:
+                clause_count += 1
+            else:
+                for child in token.children:
+                    if "IN" in child.tag_ or "WDT" in child.tag_ or "WP" in child.tag_:
+                        clause_count += 1
+
+        character_count += len(token)
+        if "PUNCT" in pos:
+            punct_count += 1
+
+        unique_tokens.add(text)
+        if tag in content_POS:
+            content_count += 1
+            unique_contents.add(text)
+
+    pos_count_tuple = (verb_count, noun_count, adj_count, adv_count, modal_count)
+
+    word_count = len(tokens)
+    if word_count is 0 or len(unique_contents) is 0 or len(unique_tokens) is 0:
+        diversity = (0,0)
+    else:
+        diversity = (word_count * 1.0 / len(unique_tokens), content_count * 1.0 / len(unique_contents))
+
+    if not parsed:
+        return (None, pos_count_tuple, None, diversity)
+
+    nc = list(tokens.noun_chunks)
+    noun_phrase_count = len(nc)
+    sentence_count = len(list(tokens.sents))
+    quantity = (word_count, noun_phrase_count, sentence_count)
+
+    if len(tokens.text) is 0 or word_count is 0 or noun_phrase_count is 0 or sentence_count is 0:
+        complexity = (0,0,0,0,0)
+    else:
+        words_in_nc_count = 0.0
+        for noun_chunk in nc:
+            words_in_nc_count += len(noun_chunk)
+        complexity = (clause_count * 1.0 / sentence_count, word_count*1.0 / sentence_count, 
+            character_count*1.0/word_count, words_in_nc_count / noun_phrase_count, punct_count / sentence_count)
+
+    return (quantity, pos_count_tuple, complexity, diversity)
+
+# counts come from a LexiconMatcher; without them the default lexicons are counted in tokens.text
+def uncertainty_analysis(tokens, counts=None):
+    if counts is None:
+        counts = lexicon_matcher.counts(tokens.text)
         
-    return (uncertainty_count, other_reference_count)
+    return (counts["uncertainty"], counts["other_reference"])
     
-def nonimmediacy_analysis(tokens):
-    
-    self_ref = ["I ", " i ", " me.", " me!", " me,", " me ", "Me "]
-    self_ref_count = 0
-    for word in self_ref:
-        self_ref_count += tokens.text.count(word)
-        
-    group_ref = ["We ", " we ", " us ", " us,", " us.", " Us ", " Us.", " us!", " Us!"]
-    group_ref_count = 0
-    for word in group_ref:
-        group_ref_count += tokens.text.count(word)
+def nonimmediacy_analysis(tokens, counts=None):
+    if counts is None:
+        counts = lexicon_matcher.counts(tokens.text)
     
-    return (self_ref_count, group_ref_count)
+    return (counts["self_reference"], counts["group_reference"])
     
 def emotiveness_analysis(counts):
     (verb_count, noun_count, adj_count, adv_count, modal_count) = counts
@@ -0,0 +1,100 @@
+# sentiment_cache.py
+# Gil Walzer
+
+import collections, json, codecs, os
+import atomic_write, vader_batch
+
+# VADER only ever splits its text on whitespace, so runs of whitespace and the ends of
+# the text don't change the scores; collapsing them lets more messages share an entry
+def normalize(message):
+    return " ".join(message.split())
+
+class SentimentCache:
+    """ Remembers VADER's scores for up to max_size messages, dropping the least recently
+    used past that. Market reviews repeat a lot ("great vendor", "fast shipping A+"), so most
+    messages are scored only once. Scores come from vader_batch, which gives the same ones
+    as VADER's own sentiment(). load and save keep the scores in a json file between runs. """
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.scores = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # the scores worked out since the last take
+        self.added = {}
+
+    # VADER's scores for message, an encoded str
+    def sentiment(self, message):
+        return self.sentiment_many([message])[0]
+
+    # sentiment for each of messages. The ones that aren't cached are scored together by
+    # vader_batch, each distinct one once.
+    def sentiment_many(self, messages):
+        keys = [normalize(message) for message in messages]
+        found = {}
+        missing = collections.OrderedDict()
+        for (key, message) in zip(keys, messages):
+            if key in found or key in missing:
+                continue
+            if key in self.scores:
+                # moved to the end, as the most recently used
+                found[key] = self.scores.pop(key)
+                self.scores[key] = found[key]
+            else:
+                missing[key] = message
+        self.misses += len(missing)
+        self.hits += len(messages) - len(missing)
+
+        if len(missing) > 0:
+            for (key, vs) in zip(missing.keys(), vader_batch.sentiment_many(missing.values())):
+                found[key] = vs
+                self.store(key, vs)
+                self.added[key] = vs
+        # copies, so nobody can change what's cached
+        return [dict(found[key]) for key in keys]
+
+    def store(self, key, vs):
+        if key in self.scores:
+            del self.scores[key]
+        elif len(self.scores) >= self.max_size:
+            self.scores.popitem(last=False)
+        self.scores[key] = vs
+
+    # hands back (and forgets) the hits, misses and new scores since the last take, so a
+    # worker process can send them home with its results
+    def take(self):
+        recorded = (self.hits, self.misses, self.added)
+        self.hits = 0
+        self.misses = 0
+        self.added = {}
+        return recorded
+
+    # for pool initializers: a forked worker starts with a copy of its parent's counts
+    def reset(self):
+        self.take()
+
+    def merge(self, recorded):
+        (hits, misses, added) = recorded
+        self.hits += hits
+        self.misses += misses
+        for (key, vs) in added.items():
+            self.store(key, vs)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        if lookups is 0:
+            hit_rate = 0.0
+        else:
+            hit_rate = self.hits * 1.0 / lookups
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate, "size": len(self.scores)}
+
+    def load(self, filepath_full):
+        if not os.path.exists(filepath_full):
+            return
+        with codecs.open(filepath_full, "r", "utf-8", errors="ignore") as cache_file:
+            entries = json.loads(cache_file.read())
+        for (key, vs) in entries[-self.max_size:]:
+            self.scores[key.encode("utf-8")] = vs
+
+    def save(self, filepath_full):
+        entries = [(key.decode("utf-8", "ignore"), vs) for (key, vs) in self.scores.items()]
+        atomic_write.write_file(filepath_full, json.dumps(entries).encode("UTF-8"))
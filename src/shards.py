@@ -0,0 +1,86 @@
+# shards.py
+# Gil Walzer
+
+import os, hashlib
+
+# A record directory (GwernJSON, GwernJSONAnalyses, ...) is either flat, with every
+# <id>.json directly inside it, or sharded, with each record in one of 256 subdirectories
+# named after the first two hex digits of the md5 of its id. A sharded directory has a
+# SHARD_MARKER file in it, and readers accept records from either layout, so a
+# directory can be migrated while it's in use.
+SHARD_MARKER = "sharded"
+
+def is_sharded(filepath):
+    return os.path.exists(filepath + SHARD_MARKER)
+
+def shard_name(fid):
+    if type(fid) is unicode:
+        fid = fid.encode("utf-8")
+    return hashlib.md5(fid).hexdigest()[:2]
+
+def is_shard_name(name):
+    return len(name) is 2 and all(c in "0123456789abcdef" for c in name)
+
+# where the record for fid gets written
+def record_path(filepath, fid, sharded):
+    if sharded:
+        return filepath + shard_name(fid) + "/" + fid + ".json"
+    return filepath + fid + ".json"
+
+# where the record for fid is now: the sharded copy if there is one, otherwise the flat one
+def find_record_path(filepath, fid):
+    path = filepath + shard_name(fid) + "/" + fid + ".json"
+    if os.path.exists(path):
+        return path
+    return filepath + fid + ".json"
+
+def record_exists(filepath, fid):
+    return os.path.exists(find_record_path(filepath, fid))
+
+# (id, path) for every record in filepath, in either layout. A record that is in both
+# (a migration that was cut short) is only listed once, from its shard.
+def list_records(filepath):
+    flat = []
+    sharded = []
+    for name in os.listdir(filepath):
+        if name.endswith(".json"):
+            flat.append((name.split(".json")[0], filepath + name))
+        elif is_shard_name(name) and os.path.isdir(filepath + name):
+            for filename in os.listdir(filepath + name):
+                # skip .tmp files from writes that never finished
+                if filename.endswith(".json"):
+                    sharded.append((filename.split(".json")[0], filepath + name + "/" + filename))
+
+    if len(sharded) is 0:
+        return flat
+    in_shards = set(fid for (fid, path) in sharded)
+    return [(fid, path) for (fid, path) in flat if fid not in in_shards] + sharded
+
+def make_sharded(filepath):
+    try:
+        os.stat(filepath)
+    except:
+        os.mkdir(filepath)
+    for i in range(256):
+        shard = filepath + "%02x" % i
+        if not os.path.isdir(shard):
+            os.mkdir(shard)
+    with open(filepath + SHARD_MARKER, "w") as marker:
+        marker.write("records are in subdirectories named by shards.shard_name\n")
+
+# Moves every flat record in filepath into its shard. New writes go to the shards as soon
+# as the marker is down, so a flat copy left behind is never newer than the sharded one.
+def migrate_to_sharded(filepath):
+    make_sharded(filepath)
+    moved = 0
+    for name in os.listdir(filepath):
+        if not name.endswith(".json"):
+            continue
+        fid = name.split(".json")[0]
+        path = record_path(filepath, fid, True)
+        if os.path.exists(path):
+            os.remove(filepath + name)
+        else:
+            os.rename(filepath + name, path)
+            moved += 1
+    return moved
@@ -1,14 +1,177 @@
 # spacycaller.py
 # Gil Walzer
 
-from spacy.en import English
+import itertools, hashlib, sqlite3, json, zlib
+import timing
+
+# spaCy takes seconds to import, so it's only imported once a profile is parsed or read back;
+# loading analyses from disk never needs it
+
+COMPONENT_NAMES = ("tagger", "parser", "entity")
+
+# One English() for the whole process, shared by every SpacyCaller; loading it is slow and it
+# takes a lot of memory. It has every component any caller has asked for, and each call turns
+# off the ones its caller doesn't use. It's only loaded again if a caller needs one it lacks.
+model = None
+model_components = set()
+
+def get_model(components):
+    global model, model_components
+    if model is None or not set(components).issubset(model_components):
+        from spacy.en import English
+        model_components = model_components.union(components)
+        # English only takes components to replace, so pass False for the ones left out
+        overrides = {}
+        for name in COMPONENT_NAMES:
+            if name not in model_components:
+                overrides[name] = False
+        model = English(**overrides)
+    return model
+
+# A Doc as bytes any process can read back with the same model. Doc.to_bytes won't do: its
+# encoding depends on which words the writing process's vocabulary had seen. Only what the
+# features use is kept: the words, their spacing, and the tags and parse if there were any.
+def doc_to_bytes(doc):
+    record = {"words": [token.text for token in doc], "spaces": [len(token.whitespace_) > 0 for token in doc]}
+    if doc.is_tagged:
+        record["tags"] = [token.tag_ for token in doc]
+    if doc.is_parsed:
+        record["heads"] = [token.head.i - token.i for token in doc]
+        record["deps"] = [token.dep_ for token in doc]
+    return zlib.compress(json.dumps(record))
+
+def doc_from_bytes(vocab, data):
+    import numpy
+    from spacy.tokens import Doc
+    from spacy.attrs import TAG, HEAD, DEP
+    record = json.loads(zlib.decompress(data))
+    doc = Doc(vocab, words=record["words"], spaces=record["spaces"])
+    attrs, columns = [], []
+    if "tags" in record:
+        attrs.append(TAG)
+        columns.append([vocab.strings[tag] for tag in record["tags"]])
+    if "heads" in record:
+        attrs.extend([HEAD, DEP])
+        columns.append(record["heads"])
+        columns.append([vocab.strings[dep] for dep in record["deps"]])
+    if len(attrs) > 0 and len(doc) > 0:
+        # assigning the tags sets the coarse parts of speech, and the heads the sentences
+        doc.from_array(attrs, numpy.array(columns, dtype="int32").T.copy())
+    doc.is_tagged = "tags" in record
+    doc.is_parsed = "heads" in record
+    return doc
+
 class SpacyCaller():
-    def __init__(self):
-        self.nlp = English()
-    
+    """ Parses vendor profiles. Given a DocCache, Docs parsed before are read back from it
+    instead, and the tagger and parser are only loaded once a profile isn't there. """
+    def __init__(self, tagger=True, parser=True, entity=True, doc_cache=None):
+        self.components = set(name for (name, wanted) in zip(COMPONENT_NAMES, (tagger, parser, entity)) if wanted)
+        # passed to each call of the shared model, which may have more components than these
+        self.flags = {"tag": tagger, "parse": parser, "entity": entity}
+        self.doc_cache = doc_cache
+        # with a cache, the tagger and parser are only loaded once a profile isn't in it
+        if doc_cache is None:
+            get_model(self.components)
+
+    def model(self):
+        return get_model(self.components)
+
     def spacy_analyze_vendor(self, vendor):
+        if self.doc_cache is not None:
+            return list(self.spacy_analyze_vendors([vendor]))[0][1]
+
         profile = vendor.profile
-        tokens = self.nlp(profile)
-        
+        started = timing.start()
+        tokens = self.model()(profile, **self.flags)
+        timing.stop("spacy_analyze_vendor", started)
+
         return tokens
-        
\ No newline at end of file
+
+    # yields (vendor, tokens) in the order the vendors come in, batch_size profiles at a time
+    def spacy_analyze_vendors(self, vendors, batch_size=1000):
+        vendors = iter(vendors)
+        while True:
+            batch = list(itertools.islice(vendors, batch_size))
+            if len(batch) is 0:
+                break
+            profiles = [vendor.profile for vendor in batch]
+            # pipe holds the Docs back until it has parsed the whole batch, so there's no
+            # telling what each one took; the batch is timed as one
+            started = timing.start()
+            if self.doc_cache is None:
+                docs = list(self.model().pipe(profiles, batch_size=batch_size, **self.flags))
+            else:
+                docs = self.cached_docs(profiles, batch_size)
+            timing.stop("spacy_analyze_batch", started)
+            timing.count("spacy_profiles", len(batch))
+            for (vendor, tokens) in zip(batch, docs):
+                yield (vendor, tokens)
+
+    def doc_key(self, profile):
+        import spacy
+        if type(profile) is unicode:
+            profile = profile.encode("utf-8")
+        return hashlib.sha1(profile).hexdigest() + "/" + spacy.__version__
+
+    # A Doc for each profile, from the cache where it's there and parsed (then cached) where it
+    # isn't. A Doc cached by a run with more components than these will do; the extra tags or
+    # parse are just left unused.
+    def cached_docs(self, profiles, batch_size):
+        keys = [self.doc_key(profile) for profile in profiles]
+        found = self.doc_cache.get_many(keys, "tagger" in self.components, "parser" in self.components)
+        timing.count("doc_cache_hits", len(found))
+
+        missing = [k for k in range(len(profiles)) if keys[k] not in found]
+        if len(missing) > 0:
+            # the model that parses the misses reads the hits back too, so there's one vocabulary
+            nlp = self.model()
+        else:
+            # only the vocabulary is needed: the shared model's, or a tokenizer-only one if
+            # nothing is loaded yet (which a miss later replaces)
+            nlp = get_model(set())
+        parsed = {}
+        if len(missing) > 0:
+            new_docs = nlp.pipe([profiles[k] for k in missing], batch_size=batch_size, **self.flags)
+            for (k, doc) in zip(missing, new_docs):
+                parsed[k] = doc
+            self.doc_cache.put_many([(keys[k], doc_to_bytes(parsed[k])) for k in missing],
+                "tagger" in self.components, "parser" in self.components)
+
+        docs = []
+        for k in range(len(profiles)):
+            if k in parsed:
+                docs.append(parsed[k])
+            else:
+                docs.append(doc_from_bytes(nlp.vocab, found[keys[k]]))
+        return docs
+
+class DocCache:
+    """ Parsed Docs kept as bytes in an SQLite file, keyed by SpacyCaller.doc_key (a hash of
+    the profile and the spaCy version) along with whether they were tagged and parsed. """
+    def __init__(self, path):
+        # worker processes share the file, so wait for each other's writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS parsed_docs (key TEXT NOT NULL, tagged INTEGER NOT NULL, "
+                "parsed INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (key, tagged, parsed))")
+
+    def close(self):
+        self.connection.close()
+
+    # {key: bytes} for those of keys that are cached with at least the tags and parse asked
+    # for; 999 is SQLite's limit on parameters
+    def get_many(self, keys, tagged, parsed):
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), 997):
+            chunk = keys[start:start + 997]
+            query = ("SELECT key, data FROM parsed_docs WHERE tagged >= ? AND parsed >= ? AND key IN (" 
+                + ", ".join(["?"] * len(chunk)) + ")")
+            for (key, data) in self.connection.execute(query, [int(tagged), int(parsed)] + chunk):
+                found[key] = str(data)
+        return found
+
+    def put_many(self, items, tagged, parsed):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO parsed_docs (key, tagged, parsed, data) VALUES (?, ?, ?, ?)",
+                [(key, int(tagged), int(parsed), sqlite3.Binary(data)) for (key, data) in items])
@@ -179,4 +179,5 @@ def main():
 		mse_sum += mse
 	print mse_sum, mse_sum * 1.0/iters
 	print mse_low_sum, mse_low_sum * 1.0/mse_low_count
-main()
\ No newline at end of file
+if __name__ == "__main__":
+	main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+# timing.py
+# Gil Walzer
+
+import time
+
+# Wall time and calls per stage of parsing and analysis, for finding where a run's time goes.
+# Off unless enable() is called; then every stage costs one function call and a global check.
+#
+#     started = timing.start()
+#     ...
+#     timing.stop("stage", started)
+enabled = False
+
+# stage name -> seconds for each call, counter name -> count
+stages = {}
+counters = {}
+
+def enable():
+    global enabled
+    enabled = True
+
+def start():
+    if enabled:
+        return time.time()
+    return None
+
+def stop(name, started):
+    if started is not None:
+        elapsed = time.time() - started
+        if name in stages:
+            stages[name].append(elapsed)
+        else:
+            stages[name] = [elapsed]
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+# hands back (and forgets) everything recorded so far, so a worker process can send it home
+def take():
+    global stages, counters
+    recorded = (stages, counters)
+    stages = {}
+    counters = {}
+    return recorded
+
+# for pool initializers: a forked worker starts with a copy of whatever its parent recorded
+def reset():
+    take()
+
+def merge(recorded):
+    (other_stages, other_counters) = recorded
+    for (name, times) in other_stages.items():
+        stages.setdefault(name, []).extend(times)
+    for (name, n) in other_counters.items():
+        counters[name] = counters.get(name, 0) + n
+
+class Collecting:
+    """ Wraps function for a pool worker so that each call returns (result, what it recorded).
+    Pass the results through collect_results to merge the timings and get the results back. """
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, *args):
+        result = self.function(*args)
+        return (result, take())
+
+def collect_results(results):
+    for (result, recorded) in results:
+        merge(recorded)
+    return [result for (result, recorded) in results]
+
+def percentile(sorted_times, p):
+    k = int(round((len(sorted_times) - 1) * p / 100.0))
+    return sorted_times[k]
+
+# a table of every stage's calls, total time and percentiles, then the counters
+def summary():
+    lines = ["%-30s %8s %10s %9s %9s %9s %9s" % ("stage", "calls", "total s", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+    for name in sorted(stages, key=lambda name: -sum(stages[name])):
+        times = sorted(stages[name])
+        lines.append("%-30s %8d %10.2f %9.2f %9.2f %9.2f %9.2f" % (name, len(times), sum(times),
+            percentile(times, 50) * 1000, percentile(times, 90) * 1000, percentile(times, 99) * 1000, times[-1] * 1000))
+    for name in sorted(counters):
+        lines.append("%-30s %8d" % (name, counters[name]))
+    return "\n".join(lines) + "\n"
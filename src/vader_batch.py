@@ -0,0 +1,284 @@
+# vader_batch.py
+# Gil Walzer
+
+import math, string
+
+# VADER's sentiment() (vaderSentiment.vaderSentiment), rearranged to score a batch of messages.
+# vaderSentiment builds its negation list, booster and idiom tables and helper functions on
+# every call, strips punctuation off each word by scanning the whole message once per word
+# and punctuation mark, and works out a repeated word's valence again for each repeat. Here
+# the tables are built once, each message is tokenized in one pass, and each distinct word's
+# valence is worked out once. Every one of VADER's rules is kept, quirks included, so the
+# scores are the same as vaderSentiment's.
+
+PUNCTUATION = set(string.punctuation)
+PUNCTUATION_MARKS = set([".", "!", "?", ",", ";", ":", "-", "'", "\"",
+    "!!", "!!!", "??", "???", "?!?", "!?!", "?!?!", "!?!?"])
+
+NEGATIONS = set(["aint", "arent", "cannot", "cant", "couldnt", "darent", "didnt", "doesnt",
+    "ain't", "aren't", "can't", "couldn't", "daren't", "didn't", "doesn't",
+    "dont", "hadnt", "hasnt", "havent", "isnt", "mightnt", "mustnt", "neither",
+    "don't", "hadn't", "hasn't", "haven't", "isn't", "mightn't", "mustn't",
+    "neednt", "needn't", "never", "none", "nope", "nor", "not", "nothing", "nowhere",
+    "oughtnt", "shant", "shouldnt", "uhuh", "wasnt", "werent",
+    "oughtn't", "shan't", "shouldn't", "uh-uh", "wasn't", "weren't",
+    "without", "wont", "wouldnt", "won't", "wouldn't", "rarely", "seldom", "despite"])
+
+B_INCR = 0.293
+B_DECR = -0.293
+# how much ALLCAPS adds to a word's valence, and what a negation multiplies it by
+C_INCR = 0.733
+N_SCALAR = -0.74
+
+BOOSTERS = {"absolutely": B_INCR, "amazingly": B_INCR, "awfully": B_INCR, "completely": B_INCR, "considerably": B_INCR,
+    "decidedly": B_INCR, "deeply": B_INCR, "effing": B_INCR, "enormously": B_INCR,
+    "entirely": B_INCR, "especially": B_INCR, "exceptionally": B_INCR, "extremely": B_INCR,
+    "fabulously": B_INCR, "flipping": B_INCR, "flippin": B_INCR,
+    "fricking": B_INCR, "frickin": B_INCR, "frigging": B_INCR, "friggin": B_INCR, "fully": B_INCR, "fucking": B_INCR,
+    "greatly": B_INCR, "hella": B_INCR, "highly": B_INCR, "hugely": B_INCR, "incredibly": B_INCR,
+    "intensely": B_INCR, "majorly": B_INCR, "more": B_INCR, "most": B_INCR, "particularly": B_INCR,
+    "purely": B_INCR, "quite": B_INCR, "really": B_INCR, "remarkably": B_INCR,
+    "so": B_INCR, "substantially": B_INCR,
+    "thoroughly": B_INCR, "totally": B_INCR, "tremendously": B_INCR,
+    "uber": B_INCR, "unbelievably": B_INCR, "unusually": B_INCR, "utterly": B_INCR,
+    "very": B_INCR,
+    "almost": B_DECR, "barely": B_DECR, "hardly": B_DECR, "just enough": B_DECR,
+    "kind of": B_DECR, "kinda": B_DECR, "kindof": B_DECR, "kind-of": B_DECR,
+    "less": B_DECR, "little": B_DECR, "marginally": B_DECR, "occasionally": B_DECR, "partly": B_DECR,
+    "scarcely": B_DECR, "slightly": B_DECR, "somewhat": B_DECR,
+    "sort of": B_DECR, "sorta": B_DECR, "sortof": B_DECR, "sort-of": B_DECR}
+
+IDIOMS = {"the shit": 3, "the bomb": 3, "bad ass": 1.5, "yeah right": -2,
+    "cut the mustard": 2, "kiss of death": -1.5, "hand to mouth": -2}
+
+# VADER's lexicon and punctuation regex, from the module itself so the words and valences
+# are always the installed version's; imported on first use, since loading the lexicon is slow
+valences = None
+punctuation_re = None
+
+def load_lexicon():
+    global valences, punctuation_re
+    if valences is None:
+        from vaderSentiment import vaderSentiment
+        valences = vaderSentiment.word_valence_dict
+        punctuation_re = vaderSentiment.regex_remove_punctuation
+
+# {"neg", "neu", "pos", "compound"} for each of messages (encoded strs), in order
+def sentiment_many(messages):
+    load_lexicon()
+    return [score(message) for message in messages]
+
+def sentiment(message):
+    return sentiment_many([message])[0]
+
+def score(text):
+    words = tokenize(text)
+    n = len(words)
+    lowered = [word.lower() for word in words]
+    upper = [word.isupper() for word in words]
+    # ALLCAPS only counts for emphasis when some of the words aren't
+    cap_differential = n - upper.count(True)
+    cap_diff = cap_differential > 0 and cap_differential < n
+
+    # VADER looks each word up with list.index, so every repeat of a word is scored as if it
+    # were the first one; the first's valence does for all of them
+    word_valences = {}
+    sentiments = []
+    for i in range(n):
+        word = words[i]
+        if word not in word_valences:
+            word_valences[word] = valence(i, words, lowered, upper, cap_diff)
+        sentiments.append(word_valences[word])
+
+    # contrastive "but": the words before it count half, those after it half again. As in
+    # VADER, each value is found with list.index, so repeated values change the first copy.
+    if "but" in words or "BUT" in words:
+        if "but" in words:
+            bi = words.index("but")
+        else:
+            bi = words.index("BUT")
+        for s in sentiments:
+            si = sentiments.index(s)
+            if si < bi:
+                sentiments.pop(si)
+                sentiments.insert(si, s*0.5)
+            elif si > bi:
+                sentiments.pop(si)
+                sentiments.insert(si, s*1.5)
+
+    return scores(text, sentiments)
+
+# VADER's words: split on whitespace, punctuation taken off the ends of any word that is
+# otherwise a word of the text, then words of one character dropped
+def tokenize(text):
+    words_only = punctuation_re.sub("", text).split()
+    # VADER removes these while iterating, which skips the word after each one removed
+    for word in words_only:
+        if len(word) <= 1:
+            words_only.remove(word)
+    known = set(words_only)
+
+    # Known words have no punctuation at all, so a word can only be one of them with a run of
+    # punctuation in front or behind; VADER only strips the runs in PUNCTUATION_MARKS.
+    words = []
+    for word in text.split():
+        if word[0] in PUNCTUATION:
+            rest = word.lstrip(string.punctuation)
+            if rest in known and word[:len(word) - len(rest)] in PUNCTUATION_MARKS:
+                word = rest
+        elif word[-1] in PUNCTUATION:
+            rest = word.rstrip(string.punctuation)
+            if rest in known and word[len(rest):] in PUNCTUATION_MARKS:
+                word = rest
+        words.append(word)
+
+    for word in words:
+        if len(word) <= 1:
+            words.remove(word)
+    return words
+
+# the negation check VADER makes on one word at a time
+def negated(word):
+    return word in NEGATIONS or "n't" in word
+
+def booster_scalar(i, lowered, upper, valence, cap_diff):
+    scalar = 0.0
+    if lowered[i] in BOOSTERS:
+        scalar = BOOSTERS[lowered[i]]
+        if valence < 0:
+            scalar *= -1
+        if upper[i] and cap_diff:
+            if valence > 0:
+                scalar += C_INCR
+            else:
+                scalar -= C_INCR
+    return scalar
+
+# the valence of words[i], given the up to three words before it
+def valence(i, words, lowered, upper, cap_diff):
+    n = len(words)
+    if (i < n - 1 and lowered[i] == "kind" and lowered[i + 1] == "of") or lowered[i] in BOOSTERS:
+        return 0
+    if lowered[i] not in valences:
+        return 0
+
+    v = float(valences[lowered[i]])
+    if upper[i] and cap_diff:
+        if v > 0:
+            v += C_INCR
+        else:
+            v -= C_INCR
+
+    if i > 0 and lowered[i - 1] not in valences:
+        v = v + booster_scalar(i - 1, lowered, upper, v, cap_diff)
+        if negated(words[i - 1]):
+            v = v*N_SCALAR
+    if i > 1 and lowered[i - 2] not in valences:
+        s2 = booster_scalar(i - 2, lowered, upper, v, cap_diff)
+        if s2 != 0:
+            s2 = s2*0.95
+        v = v + s2
+        # "never so" and "never this" intensify instead of negating
+        if words[i - 2] == "never" and (words[i - 1] == "so" or words[i - 1] == "this"):
+            v = v*1.5
+        elif negated(words[i - 2]):
+            v = v*N_SCALAR
+    if i > 2 and lowered[i - 3] not in valences:
+        s3 = booster_scalar(i - 3, lowered, upper, v, cap_diff)
+        if s3 != 0:
+            s3 = s3*0.9
+        v = v + s3
+        if words[i - 3] == "never" and (words[i - 2] == "so" or words[i - 2] == "this") or \
+            (words[i - 1] == "so" or words[i - 1] == "this"):
+            v = v*1.25
+        elif negated(words[i - 3]):
+            v = v*N_SCALAR
+
+        # VADER only checks the idioms here, with three words before this one
+        onezero = words[i - 1] + " " + words[i]
+        twoonezero = words[i - 2] + " " + words[i - 1] + " " + words[i]
+        twoone = words[i - 2] + " " + words[i - 1]
+        threetwoone = words[i - 3] + " " + words[i - 2] + " " + words[i - 1]
+        threetwo = words[i - 3] + " " + words[i - 2]
+        if onezero in IDIOMS:
+            v = IDIOMS[onezero]
+        elif twoonezero in IDIOMS:
+            v = IDIOMS[twoonezero]
+        elif twoone in IDIOMS:
+            v = IDIOMS[twoone]
+        elif threetwoone in IDIOMS:
+            v = IDIOMS[threetwoone]
+        elif threetwo in IDIOMS:
+            v = IDIOMS[threetwo]
+        # VADER's three-word check after the word formats only two of them, so both are this
+        if n - 1 > i and words[i] + " " + words[i + 1] in IDIOMS:
+            v = IDIOMS[words[i] + " " + words[i + 1]]
+
+        # booster bigrams such as "sort of" and "kind of"
+        if threetwo in BOOSTERS or twoone in BOOSTERS:
+            v = v + B_DECR
+
+    # negation with "least", except for "at least" and "very least"
+    if i > 1 and lowered[i - 1] not in valences and lowered[i - 1] == "least":
+        if lowered[i - 2] != "at" and lowered[i - 2] != "very":
+            v = v*N_SCALAR
+    elif i > 0 and lowered[i - 1] not in valences and lowered[i - 1] == "least":
+        v = v*N_SCALAR
+    return v
+
+# the four scores from the words' valences, with VADER's emphasis for "!" and "?"
+def scores(text, sentiments):
+    if sentiments:
+        sum_s = float(sum(sentiments))
+
+        ep_count = text.count("!")
+        if ep_count > 4:
+            ep_count = 4
+        ep_amplifier = ep_count*0.292
+        if sum_s > 0:
+            sum_s += ep_amplifier
+        elif sum_s < 0:
+            sum_s -= ep_amplifier
+
+        qm_count = text.count("?")
+        qm_amplifier = 0
+        if qm_count > 1:
+            if qm_count <= 3:
+                qm_amplifier = qm_count*0.18
+            else:
+                qm_amplifier = 0.96
+            if sum_s > 0:
+                sum_s += qm_amplifier
+            elif sum_s < 0:
+                sum_s -= qm_amplifier
+
+        compound = sum_s/math.sqrt((sum_s*sum_s) + 15)
+
+        pos_sum = 0.0
+        neg_sum = 0.0
+        neu_count = 0
+        for sentiment_score in sentiments:
+            # the 1s make up for neutral words counting as 1
+            if sentiment_score > 0:
+                pos_sum += (float(sentiment_score) + 1)
+            if sentiment_score < 0:
+                neg_sum += (float(sentiment_score) - 1)
+            if sentiment_score == 0:
+                neu_count += 1
+
+        if pos_sum > math.fabs(neg_sum):
+            pos_sum += (ep_amplifier + qm_amplifier)
+        elif pos_sum < math.fabs(neg_sum):
+            neg_sum -= (ep_amplifier + qm_amplifier)
+
+        total = pos_sum + math.fabs(neg_sum) + neu_count
+        pos = math.fabs(pos_sum / total)
+        neg = math.fabs(neg_sum / total)
+        neu = math.fabs(neu_count / total)
+    else:
+        compound = 0.0
+        pos = 0.0
+        neg = 0.0
+        neu = 0.0
+
+    return {"neg": round(neg, 3), "neu": round(neu, 3), "pos": round(pos, 3), "compound": round(compound, 4)}
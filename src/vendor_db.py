@@ -0,0 +1,116 @@
+# vendor_db.py
+# Gil Walzer
+
+import sqlite3, json, itertools
+import parse_vendors, rigorous_analysis
+
+# Keeps vendors and analyses in one SQLite file instead of a directory of json files.
+# Every record sits under a classifier, the name debug uses for the directory it would
+# have been written to ("GwernJSON", "GwernJSONAnalyses", ...), and holds the same json.
+class VendorDB:
+
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS records (classifier TEXT NOT NULL, id TEXT NOT NULL, "
+                "username TEXT, data TEXT NOT NULL, PRIMARY KEY (classifier, id))")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS records_username ON records (classifier, username)")
+
+    def close(self):
+        self.connection.close()
+
+    # records are (id, username, json) tuples, inserted batch_size at a time, one transaction per batch
+    def write_records(self, classifier, records):
+        records = iter(records)
+        while True:
+            batch = [(classifier, fid, username, data) for (fid, username, data) in itertools.islice(records, self.batch_size)]
+            if len(batch) is 0:
+                break
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO records (classifier, id, username, data) VALUES (?, ?, ?, ?)", batch)
+
+    def iter_records(self, classifier):
+        cursor = self.connection.execute("SELECT data FROM records WHERE classifier = ? ORDER BY id", (classifier,))
+        for (data,) in cursor:
+            yield data
+
+    def record_exists(self, classifier, fid):
+        cursor = self.connection.execute("SELECT 1 FROM records WHERE classifier = ? AND id = ?", (classifier, fid))
+        return cursor.fetchone() is not None
+
+    # in the order of ids; 999 is SQLite's limit on parameters per statement
+    def read_records_by_ids(self, classifier, ids):
+        found = {}
+        for start in range(0, len(ids), 998):
+            chunk = list(ids[start:start + 998])
+            query = "SELECT id, data FROM records WHERE classifier = ? AND id IN (" + ", ".join(["?"] * len(chunk)) + ")"
+            for (fid, data) in self.connection.execute(query, [classifier] + chunk):
+                found[fid] = data
+
+        records = []
+        for fid in ids:
+            if fid not in found:
+                raise KeyError("no " + classifier + " record for " + str(fid))
+            records.append(found[fid])
+        return records
+
+    def iter_records_except_ids(self, classifier, no_ids):
+        with self.connection:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS excluded (id TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM excluded")
+            self.connection.executemany("INSERT OR IGNORE INTO excluded (id) VALUES (?)", [(fid,) for fid in no_ids])
+        cursor = self.connection.execute("SELECT data FROM records WHERE classifier = ? AND id NOT IN (SELECT id FROM excluded) ORDER BY id", (classifier,))
+        # fetch everything before the temp table can be reused by another call
+        rows = cursor.fetchall()
+        for (data,) in rows:
+            yield data
+
+    # records in classifier with no record under the same id in other_classifier
+    def iter_records_without(self, classifier, other_classifier):
+        cursor = self.connection.execute("SELECT r.data FROM records r WHERE r.classifier = ? AND NOT EXISTS "
+            "(SELECT 1 FROM records o WHERE o.classifier = ? AND o.id = r.id) ORDER BY r.id", (classifier, other_classifier))
+        for (data,) in cursor:
+            yield data
+
+    def get_ids_for_usernames(self, classifier, unames):
+        idents = []
+        for uname in unames:
+            row = self.connection.execute("SELECT id FROM records WHERE classifier = ? AND username = ? LIMIT 1", (classifier, uname)).fetchone()
+            if row is None:
+                idents.append(None)
+            else:
+                idents.append(row[0])
+        return idents
+
+    # writes each batch of vendors, then hands them on
+    def iter_write_vendors(self, vendors, classifier):
+        vendors = iter(vendors)
+        while True:
+            batch = list(itertools.islice(vendors, self.batch_size))
+            if len(batch) is 0:
+                break
+            self.write_records(classifier, [(vendor.id, vendor.username, json.dumps(vendor.__dict__)) for vendor in batch])
+            for vendor in batch:
+                yield vendor
+
+    def iter_vendors(self, classifier):
+        for data in self.iter_records(classifier):
+            yield parse_vendors.create_Vendor_from_json(data)
+
+    def iter_unanalyzed_vendors(self, classifier):
+        for data in self.iter_records_without(classifier, classifier + "Analyses"):
+            yield parse_vendors.create_Vendor_from_json(data)
+
+    def write_analyses(self, analyses, classifier):
+        self.write_records(classifier, ((analysis.vendor_id, analysis.username, json.dumps(analysis.__dict__)) for analysis in analyses))
+
+    def read_analyses(self, classifier):
+        return [rigorous_analysis.create_Analysis_from_json(data) for data in self.iter_records(classifier)]
+
+    def read_analyses_by_ids(self, classifier, ids):
+        return [rigorous_analysis.create_Analysis_from_json(data) for data in self.read_records_by_ids(classifier, ids)]
+
+    def read_analyses_except_ids(self, classifier, no_ids):
+        return [rigorous_analysis.create_Analysis_from_json(data) for data in self.iter_records_except_ids(classifier, no_ids)]